@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# File encoding: utf-8
+'''Times parseIfDirective over the #if and #elif lines of the headers
+under a directory, evaluated with the macros defined by a header.
+
+	python benchmarks/conditions.py [--corpus DIR] [--header FILE]
+
+Pass --root to time the cinterface package of another checkout, such as
+one of an older revision.
+'''
+from __future__ import with_statement
+from __future__ import absolute_import
+from __future__ import print_function
+
+import io
+import optparse
+import os
+import re
+import sys
+import time
+
+# An #if or #elif line; the lines with comments are left out, as the
+# older evaluators did not expect them
+conditionLine = re.compile(r'\s*#\s*(if|elif)\s')
+
+
+def readCorpus(directory):
+	'''Returns the #if and #elif lines of the .h files under directory,
+	with continued lines joined
+	'''
+	corpus = []
+	for root, dirs, files in os.walk(directory, followlinks=True):
+		dirs.sort()
+		for name in sorted(files):
+			if not name.endswith('.h'):
+				continue
+			try:
+				with io.open(os.path.join(root, name), encoding='latin1') as f:
+					text = f.read().replace('\\\n', ' ')
+			except (IOError, OSError):
+				continue
+			for l in text.split('\n'):
+				if conditionLine.match(l) and '/*' not in l and '//' not in l:
+					corpus.append(l + '\n')
+	return corpus
+
+
+def headerDefinitions(cpp, header, path):
+	'''Returns the macros defined by preprocessing header, or the
+	predefined macros only if header is empty
+	'''
+	d = {}
+	for bits, name in [(8, 'CHAR'), (16, 'SHORT'), (32, 'INT'), (64, 'LONG'),
+			(64, 'LONGLONG'), (64, 'SIZE'), (64, 'PTRDIFF'), (64, 'INTPTR'),
+			(32, 'WCHAR'), (32, 'ATOMIC'), (32, 'CLOCK'), (64, 'TIME'),
+			(32, 'WCTRANS'), (32, 'WCTYPE'), (32, 'WINT')]:
+		d['__CPP_%s_BITS' % name] = str(bits)
+	d['__CPP_CHAR_SIGNED'] = '1'
+	for item in ['__asm__(x) ', '__asm(x) ']:
+		cpp.defineMacro(item, d)
+	if header:
+		cpp.preprocess(header, d, path)
+	if hasattr(cpp, 'Definitions'):
+		d = cpp.Definitions(d)
+	return d
+
+
+def main(argv = None):
+	parser = optparse.OptionParser()
+	parser.add_option('--corpus', dest='corpus', default='/usr/include',
+			help='Read the #if and #elif lines of the headers under DIR (default /usr/include)',
+			metavar='DIR')
+	parser.add_option('--header', dest='header', default='sqlite3.h',
+			help='Evaluate with the macros defined by FILE (default sqlite3.h, none if empty)',
+			metavar='FILE')
+	parser.add_option('-I', '--include', dest='path', action='append', default=[],
+			help='Append search path for FILE')
+	parser.add_option('--repeat', dest='repeat', type='int', default=5,
+			help='Report the best of N passes (default 5)', metavar='N')
+	parser.add_option('--reuse', dest='reuse', action='store_true',
+			help='Keep the values of the expressions found by the previous passes')
+	parser.add_option('--root', dest='root',
+			default=os.path.dirname(os.path.dirname(os.path.abspath(__file__) ) ),
+			help='Import cinterface from DIR (default the checkout of this script)',
+			metavar='DIR')
+	options, args = parser.parse_args(argv)
+	sys.path.insert(0, options.root)
+	sys.setrecursionlimit(10000)
+	from cinterface import cpp
+
+	path = options.path + [os.path.join(options.root, 'cinterface', 'include'), options.corpus]
+	d = headerDefinitions(cpp, options.header, path)
+	corpus = readCorpus(options.corpus)
+	# Only time the expressions every evaluator accepts
+	expressions = []
+	for l in corpus:
+		try:
+			cpp.parseIfDirective(l, d)
+		except Exception:
+			continue
+		expressions.append(l)
+	if not expressions:
+		parser.error('No #if or #elif lines found under ' + options.corpus)
+	best = None
+	for i in range(options.repeat):
+		if not options.reuse and hasattr(d, 'conditions'):
+			d.conditions.clear()
+		start = time.time()
+		for l in expressions:
+			cpp.parseIfDirective(l, d)
+		seconds = time.time() - start
+		if best is None or seconds < best:
+			best = seconds
+	print('%d expressions (%d found), best of %d: %.3f s, %.1f us/expr' % (len(expressions),
+			len(corpus), options.repeat, best, best / len(expressions) * 1e6) )
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# File encoding: utf-8
+'''Reports the time and peak resident set size of preprocessing a
+synthetic header whose lines expand to many tokens.
+
+	python benchmarks/memory.py [--depth N] [--lines N] [--legacy-expansion]
+
+E0 is six tokens, and each of E1 to E<depth> repeats the previous level
+ten times.  Each line of the header holds E<depth> and G(E<depth-1>),
+where G(x) is five F(x).  The peak is that of the whole process, so run
+the script once per measurement.  Pass --root to measure the cinterface
+package of another checkout, such as one of an older revision.
+'''
+from __future__ import with_statement
+from __future__ import absolute_import
+from __future__ import print_function
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def syntheticHeader(depth, lines):
+	'''Returns the text of the synthetic header'''
+	l = ['#define E0 alpha, beta, gamma, delta, (epsilon), F(zeta),', '#define F(x) x',
+			'#define G(x) F(x) F(x) F(x) F(x) F(x)']
+	for level in range(1, depth + 1):
+		l.append('#define E%d' % level + (' E%d' % (level - 1) ) * 10)
+	for i in range(lines):
+		l.append('int table%d[] = { E%d G(E%d) };' % (i, depth, depth - 1) )
+	return '\n'.join(l) + '\n'
+
+
+def peakMegabytes():
+	'''Returns the peak resident set size of the process in megabytes'''
+	import resource
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		# Reported in bytes rather than kilobytes
+		peak /= 1024.
+	return peak / 1024.
+
+
+def main(argv = None):
+	parser = optparse.OptionParser()
+	parser.add_option('--depth', dest='depth', type='int', default=4,
+			help='Expand macros nested N levels deep (default 4)', metavar='N')
+	parser.add_option('--lines', dest='lines', type='int', default=3,
+			help='Write N lines using the macros (default 3)', metavar='N')
+	parser.add_option('--legacy-expansion', dest='legacy', action='store_true',
+			help='Use the original macro expansion engine')
+	parser.add_option('--root', dest='root',
+			default=os.path.dirname(os.path.dirname(os.path.abspath(__file__) ) ),
+			help='Import cinterface from DIR (default the checkout of this script)',
+			metavar='DIR')
+	options, args = parser.parse_args(argv)
+	if options.depth < 1:
+		parser.error('--depth must be at least 1')
+	sys.path.insert(0, options.root)
+	sys.setrecursionlimit(10000)
+	from cinterface import cpp
+
+	d = {}
+	if options.legacy:
+		d['__CPP_legacy__'] = '1'
+	directory = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(directory, 'synthetic.h')
+		with open(filename, 'w') as f:
+			f.write(syntheticHeader(options.depth, options.lines) )
+		start = time.time()
+		output = cpp.preprocess(filename, d, [])
+		seconds = time.time() - start
+	finally:
+		shutil.rmtree(directory)
+	print('%d output characters, %.2f s, peak RSS %.1f MB' % (len(output), seconds, peakMegabytes() ) )
+
+
+if __name__ == '__main__':
+	main()
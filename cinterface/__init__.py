@@ -27,6 +27,6 @@ check_reload('cinterface')
 # Delete unneccessary names from the namespace
 del absolute_import, check_reload
 
-__all__ = ['include', 'close', 'save', 'load', 'CFunctionPointer', 'calculate', 'pointer', 'getType', 'LoadLibrary', 'cast']
+__all__ = ['include', 'close', 'save', 'load', 'CFunctionPointer', 'calculate', 'pointer', 'getType', 'LoadLibrary', 'cast', 'snapshot', 'dependencies', 'macros']
 
-from .transform import include, close, save, load, CFunctionPointer, calculate, pointer, getType, LoadLibrary, cast
+from .transform import include, close, save, load, CFunctionPointer, calculate, pointer, getType, LoadLibrary, cast, snapshot, dependencies, macros
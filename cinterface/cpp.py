@@ -14,7 +14,6 @@ from __future__ import with_statement
 '''
 Unsupported/unimplemented/untested features:
 Digraphs and trigraphs
-'?' conditional operator
 Multi-character and wide character constants
 Distinguishing between preprocessing numbers with embedded macros
 Test unicode handling on non-UTF8 locales
@@ -27,8 +26,12 @@ Development notes:
 strand: piece of a string
 Token: item that contains information representing a strand including
 		previous macro expansions
+hide-set: the macros a token resulted from (Token.macroHistory); a token is
+		never expanded by a macro in its own hide-set
 '''
+import bisect
 import codecs
+import hashlib
 import locale
 import logging
 import os
@@ -40,8 +43,14 @@ import time
 try:
 	import builtins
 	long = int
+	stringTypes = (str,)
 except ImportError:
 	next = lambda obj: obj.next()
+	stringTypes = (basestring,)
+try:
+	from collections.abc import MutableMapping
+except ImportError:
+	from collections import MutableMapping
 
 # Module data: the compiled regular expression objects used in this module
 
@@ -49,7 +58,7 @@ except ImportError:
 # the second group is the first word of the directive's argument
 anyDirective = re.compile(r'^[\s\000]*#[\s\000]*'
 		+ r'(include|ifdef|ifndef|if|define|undef|error|warning|line|pragma|else|elif|endif)?'
-		+ r'[\s\000]+(\S*)') # Any directive
+		+ r'(?:[\s\000]+|$)(\S*)') # Any directive
 
 lineComment = re.compile(r'//.*')  # finds // style comments
 blockComment = re.compile(r'/\*.*') # finds the beginning of /* ... */ comments
@@ -58,22 +67,37 @@ lineContinuation = re.compile(r'\\[\s\000]*$')
 definedWithVarDirective = re.compile(r'[\s\000]*defined[\s\000]*\(*\s*(\w+)') # #define
 
 onlyTokenList = re.compile(r'(\w+)|(\(|\))|(\.\.\.)|(\S)|(\s+)')
+# Matches one preprocessing token (identifier, number, string or character
+# constant, or punctuator) or a run of whitespace
+ppTokenList = re.compile(r'\s+|[^\W\d]\w*|\.?[0-9](?:[eEpP][+-]|[\w.])*'
+		+ r'|"(?:[^"\\\n]|\\.)*"?' + r"|'(?:[^'\\\n]|\\.)*'?"
+		+ r'|\.\.\.|##|<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&^|]=|.')
+# Finds the identifiers in a line, and possibly parts of numbers or strings
+identifiers = re.compile(r'[^\W\d]\w*')
+# Finds the strings, commas and parentheses of a macro argument list
+argumentDelimiters = re.compile(r'"(?:[^"\\]|\\[\s\S])*"?|[(),]')
 defineArgs = re.compile(r'(\w+)' + r'(\([^\)]*\))?' + r'\s*(.*)')
-tokenList = re.compile(r'defined|\w+\(.*\)'
-		+ r'|[\w\'\\]+|\(|\)|!=|==|\|\||&&|##|#|<<|>>|&|\^|\||~|%|>=|>|<=|<|\+|-|\*|/|!')
+# Finds the string literals and character constants in the operand of #
+quotedLiterals = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+
+# Finds the start of a comment, or a string or character constant that
+# may hide one, in a logical line
+commentOrQuote = re.compile(r'"(?:[^"\\\r\n]|\\.)*"?' + r"|'(?:[^'\\\r\n]|\\.)'"
+		+ r'|/\*|//')
 
-# blockDelimiter: one of the characters that should be treated as the
-# beginning or end of a string that should not be analyzed (thus, is a block)
-blockDelimiter = re.compile(r'(\")|(/\*|\*/|//)')
+# Matches the directive that starts a classic include guard,
+# #ifndef NAME or #if !defined(NAME); the guard macro is group 1 or 2
+includeGuard = re.compile(r'^[\s\000]*#[\s\000]*(?:ifndef[\s\000]+(\w+)'
+		+ r'|if[\s\000]*![\s\000]*defined[\s\000]*(?:\([\s\000]*(\w+)[\s\000]*\)|[\s\000]+(\w+)))'
+		+ r'[\s\000]*$')
 
-# Matches a valid conditional directive (ifdef, ifndef, if, or endif)
-condDirective = re.compile(r'^[\s\000]*#[\s\000]*'
-		+ r'(ifdef|ifndef|if|endif)'
-		+ r'[\s\000]+')
+# Matches a conditional directive (ifdef, ifndef, if, elif, else, or endif)
+condDirective = re.compile(r'[\s\000]*#[\s\000]*'
+		+ r'(ifdef|ifndef|if|elif|else|endif)\b')
 
 # Used in isCNumber
-integers = re.compile(r'^([+-]?[0-9]+)(([uU]?[lL]?)$|([lL]?[uU]?)$)')
-hexnumbers = re.compile(r'^(0[xX][0-9a-fA-F]+)(([uU]?[lL]?)$|([lL]?[uU]?)$)')
+integers = re.compile(r'^([+-]?[0-9]+)(([uU]?[lL]{0,2})$|([lL]{0,2}[uU]?)$)')
+hexnumbers = re.compile(r'^(0[xX][0-9a-fA-F]+)(([uU]?[lL]{0,2})$|([lL]{0,2}[uU]?)$)')
 charconstant = re.compile(r"'(\w)'")
 octalconstant = re.compile(r"^'\\([0-7]+)'")
 hexconstant = re.compile(r"^'\\x([0-9a-fA-F]+)'")
@@ -81,6 +105,18 @@ escapesequence = re.compile(r"'\\([abfnrtv\\'\"\?])'")
 escapedict = {'a':7, 'b':8, 'f':12, 'n':10, 'r':13, 't':9, 'v':11,
 		'\\':92, "'":39, '"':34, '?':63}
 
+# Increment when the format of the preprocessed-output cache changes
+cacheVersion = 2
+# Upper bound on the total size in bytes of a cache directory
+cacheSizeLimit = 64 * 1024 * 1024
+
+# Include files already looked for, shared by all calls to preprocess:
+# (name, search path, current directory) -> (full path or None,
+# directories looked in, their modification times)
+resolvedIncludes = {}
+# The standard header directories, keyed by what they depend on
+systemHeaderPaths = {}
+
 
 def flattenList(l):
 	'''Return a generator yielding each element from a nested list'''
@@ -112,11 +148,66 @@ def warnUnicodeError(e):
 codecs.register_error('warn', warnUnicodeError)
 
 
+# Hide-sets are frozensets that are interned, so tokens with the same macro
+# history share one set; the unions computed from them are remembered.
+# Both tables are emptied when they grow past maxHideSets entries.
+emptyHideSet = frozenset()
+hideSets = {}
+hideSetUnions = {}
+maxHideSets = 100000
+
+def internHideSet(s):
+	'''Returns the shared hide-set equal to the set s'''
+	s = frozenset(s)
+	if len(hideSets) > maxHideSets:
+		hideSets.clear()
+	return hideSets.setdefault(s, s)
+
+
+def hideSetUnion(a, b):
+	'''Returns the shared hide-set that is the union of the hide-sets a and b'''
+	if a is b or not b:
+		return a
+	if not a:
+		return b
+	key = (a, b)
+	try:
+		return hideSetUnions[key]
+	except KeyError:
+		pass
+	if len(hideSetUnions) > maxHideSets:
+		hideSetUnions.clear()
+	u = a | b
+	u = hideSetUnions[key] = internHideSet(u)
+	return u
+
+
+def hideSetAdd(a, name):
+	'''Returns the shared hide-set containing the hide-set a and the macro name'''
+	key = (a, name)
+	try:
+		return hideSetUnions[key]
+	except KeyError:
+		pass
+	if name in a:
+		return a
+	if len(hideSetUnions) > maxHideSets:
+		hideSetUnions.clear()
+	u = a | frozenset([name])
+	u = hideSetUnions[key] = internHideSet(u)
+	return u
+
+
 class Token(object):
-	'''An object that contains several properties of a preprocessing token'''
-	def __init__(self, value = None, string = '', shouldRescan = 1, macroHistory = None):
+	'''An object that contains several properties of a preprocessing token.
+	The macroHistory attribute is the token's hide-set, which is shared with
+	other tokens and must be replaced rather than modified.
+	'''
+	__slots__ = ('value', 'string', 'shouldRescan', 'macroHistory')
+	
+	def __init__(self, value = None, string = '', shouldRescan = 1, macroHistory = emptyHideSet):
 		if macroHistory is None:
-			macroHistory = set()
+			macroHistory = emptyHideSet
 		self.value = value
 		self.string = string
 		self.shouldRescan = shouldRescan
@@ -126,6 +217,9 @@ class Token(object):
 		return ('Token[' + repr(self.value) + ', ' + repr(self.string) + ', '
 				+ repr(self.shouldRescan) + ', ' + repr(self.macroHistory) +  ']')
 
+# Stands for the whitespace separating the tokens of a macro argument
+spaceToken = Token(' ', ' ')
+
 
 def getStringEnd(iterator):
 	'''Returns the index of the end of a double-quote delimited string'''
@@ -146,6 +240,14 @@ def stringify(s):
 	return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
 
+def stringizeOperand(s):
+	'''Returns the string literal made by the # operator from the text s of
+	its operand, in which only the backslashes and quotes of the string
+	literals and character constants are escaped
+	'''
+	return '"' + quotedLiterals.sub(lambda m: stringify(m.group() )[1:-1], s) + '"'
+
+
 def blockify(iterator, strStart):
 	'''Returns the tokens within a parenthesized or quoted expression as a list
 	along with the final value of the parenthesis balance.  Requires an
@@ -175,25 +277,32 @@ def blockify(iterator, strStart):
 
 def splitArgumentList(s):
 	'''Return a list of tokens separated by commas at the top level, thus
-	parsing a function's argument list
+	parsing a function's argument list.  Whitespace is collapsed to a
+	single space.  Only the strings, commas and parentheses are examined.
 	'''
-	s = re.sub('\s+', ' ', s)
 	l = []
 	pos = 0
-	iterator = re.finditer(r'[",\(\)]', s)
-	for token in iterator:
-		if token.group() == ',':
-			tokens = s[pos:token.start()].strip()
-			l.append(tokens)
-			pos = token.end()
-		elif token.group() == '"':
-			stringEnd = getStringEnd(iterator)
-		elif token.group() == '(':
-			pEnd = findMatchingParen(iterator)
-	l.append(s[pos:].strip())
+	parenBalance = 0
+	for token in argumentDelimiters.finditer(s):
+		c = token.group()
+		if c == ',':
+			if not parenBalance:
+				l.append(' '.join(s[pos:token.start()].split() ) )
+				pos = token.end()
+		elif c == '(':
+			parenBalance += 1
+		elif c == ')':
+			if parenBalance:
+				parenBalance -= 1
+	l.append(' '.join(s[pos:].split() ) )
 	# The last element of the list will be the length of the string
-	# that corresponds to the list
-	l.append(len(s))
+	# that corresponds to the list, with its whitespace collapsed
+	length = len(' '.join(s.split() ) )
+	if s[:1].isspace():
+		length += 1
+	if s[-1:].isspace() and s.strip():
+		length += 1
+	l.append(length)
 	return l
 
 
@@ -273,18 +382,19 @@ def expandFunctionLikeMacro(macroName, token, d):
 	'''
 	if macroName == '__CPP_STRINGIFY__':
 		block = stringify(token.string[1:-1].strip())
-		token.macroHistory.add(macroName)
+		token.macroHistory = hideSetAdd(token.macroHistory, macroName)
 		outtoken_part = expandList(block, d, token.macroHistory)
 	elif macroName == '__CPP_MERGE__':
 		block = token.string[1:-1]
 		outtoken_part = expandList(block, d, token.macroHistory)
 	else:
-		expansion = d['__CPP_expansion__'][macroName]
-		argList = d['__CPP_arguments__'][macroName]
+		macro = d.macros[macroName]
+		argList = macro.params
 		arguments = splitArgumentList(token.string[1:-1])
 		expandedArgs = []
 		for arg, argName in zip(arguments[:-1], argList):
-			if '${' + argName + '}' in flattenList(expansion):
+			# This engine does not expand the variable arguments in advance
+			if argName in macro.usedParams and argName != '...':
 				expandedArgs.append(expandLine(arg, d))
 			else:
 				expandedArgs.append('')
@@ -292,16 +402,16 @@ def expandFunctionLikeMacro(macroName, token, d):
 		origArgList.extend(argList)
 		arguments.pop()
 		arguments.extend(expandedArgs)
-		token.macroHistory.add(macroName)
+		token.macroHistory = hideSetAdd(token.macroHistory, macroName)
 		if '...' in argList:
-			namedArgLen = len(d['__CPP_arguments__'][macroName]) - 1
+			namedArgLen = len(argList) - 1
 			newargs = arguments[:namedArgLen]
 			newargs.append(','.join(arguments[namedArgLen:len(expandedArgs)]) )
 			newargs.extend(expandedArgs[:namedArgLen])
 			newargs.append(','.join(expandedArgs[namedArgLen:len(expandedArgs)]) )
 			arguments = newargs
 		tokensDict = dict(list(zip(origArgList, arguments)))
-		outtoken_part = expandList(d['__CPP_expansion__'][macroName], d, token.macroHistory, tokensDict)
+		outtoken_part = expandList(macro.expansion, d, token.macroHistory, tokensDict)
 		if '...' in argList:
 			for idx, tt in enumerate(outtoken_part):
 				if tt.string == '__VA_ARGS__':
@@ -438,7 +548,7 @@ def expandTokens( s, d, tokens, unbalancedParens):
 				outtoken.append( token )
 			else:
 				replacedToken = 1
-				token.macroHistory.add(token.value)
+				token.macroHistory = hideSetAdd(token.macroHistory, token.value)
 				expandedTokens, uParens = tokenize(d[token.value], d, token.macroHistory)
 				outtoken.extend(expandedTokens)
 		else:
@@ -458,16 +568,14 @@ def expandList(tokens, d, macroHistory = None, tokensDict = None):
 	outtokens = []
 	shouldRescan = 1
 	if macroHistory == None:
-		macroHistory = set()
-	else:
-		macroHistory = macroHistory.copy()
+		macroHistory = emptyHideSet
 	for token in tokens:
 		if token[0:2] == '${':
 			unexpandedKey = '__' + token[2:-1]
 			if ( unexpandedKey in tokensDict
 					and tokensDict[token[2:-1]] != tokensDict[unexpandedKey] ):
 				mm = findMacros(tokensDict[token[2:-1]], d)
-				macroHistory.update( mm )
+				macroHistory = hideSetUnion(macroHistory, internHideSet(mm))
 		if isinstance(token, list):
 			joinedArgs = [tokensDict[t[2:-1]] if t[0:2] == '${' and t[-1] == '}' and t[2:-1] in tokensDict else t for t in token]
 			tokenstr = '(' + ''.join(joinedArgs) + ')'
@@ -480,12 +588,11 @@ def expandList(tokens, d, macroHistory = None, tokensDict = None):
 					tokenstr = '(' + ''.join(t[:-1]) + ')'
 				else:
 					tokenstr = t
-				parenMacroHistory = macroHistory.copy()
-				outtokens.append(Token(t, tokenstr, shouldRescan, parenMacroHistory) )
+				outtokens.append(Token(t, tokenstr, shouldRescan, macroHistory) )
 			continue
 		else:
 			tokenstr = token
-		outtokens.append( Token(token, tokenstr, shouldRescan, macroHistory.copy() ) )
+		outtokens.append( Token(token, tokenstr, shouldRescan, macroHistory) )
 	
 	return outtokens
 
@@ -497,24 +604,288 @@ def tokenize(s, d, macroHistory = None):
 	tokens = []
 	shouldRescan = 1
 	if macroHistory == None:
-		macroHistory = set()
+		macroHistory = emptyHideSet
 	for strand in strands:
 		if isinstance(strand, list):
 			strandString = '(' + ''.join(strand[:-1]) + ')'
 		else:
 			strandString = strand
-		tokens.append(Token(strand, strandString, shouldRescan, macroHistory.copy() ))
+		tokens.append(Token(strand, strandString, shouldRescan, macroHistory))
 	
 	return tokens, unbalancedParens
 
 
+def lexTokens(s, macroHistory = emptyHideSet):
+	'''Split the string s into a list of preprocessing tokens that share the
+	hide-set macroHistory.  Whitespace is kept as separate tokens so the
+	expanded line can be reassembled exactly.
+	'''
+	return [Token(strand, strand, 1, macroHistory) for strand in ppTokenList.findall(s)]
+
+
+def readLine(d):
+	'''Returns the next line of the file being preprocessed, or None when
+	there is no open file or its end has been reached
+	'''
+	preprocessor = getattr(d, 'preprocessor', None)
+	if preprocessor is None or not preprocessor.files:
+		return None
+	try:
+		return getNextLine(d)
+	except StopIteration:
+		return None
+
+
+def collectArguments(stack, pos, d, maxArgs, moreLines):
+	'''Collect the arguments of a function-like macro invocation whose open
+	parenthesis is stack[pos]; the stack holds the unread tokens in reverse
+	order.  Whitespace within an argument is collapsed to a single space.
+	At most maxArgs arguments are split at commas, so the last one keeps
+	any further commas (the variable arguments).  Removes the invocation
+	from the stack and returns the arguments as lists of tokens along with
+	the closing parenthesis, or returns None if the invocation does not end.
+	'''
+	args = [[]]
+	parenBalance = 1
+	idx = pos - 1
+	while 1:
+		if idx < 0:
+			# The invocation continues on the next line of the file
+			nl = None
+			if moreLines:
+				nl = readLine(d)
+			if nl is None:
+				return None
+			newTokens = lexTokens(nl)
+			stack[0:0] = newTokens[::-1]
+			idx += len(newTokens)
+			continue
+		token = stack[idx]
+		idx -= 1
+		value = token.value
+		if value == '(':
+			parenBalance += 1
+		elif value == ')':
+			parenBalance -= 1
+			if parenBalance == 0:
+				del stack[idx+1:]
+				for arg in args:
+					if arg and arg[-1] is spaceToken:
+						arg.pop()
+				return args, token
+		elif value == ',' and parenBalance == 1 and len(args) != maxArgs:
+			args.append([])
+			continue
+		elif value.isspace():
+			if args[-1] and args[-1][-1] is not spaceToken:
+				args[-1].append(spaceToken)
+			continue
+		args[-1].append(token)
+
+
+def substituteArguments(macro, args, macroHistory, d, names = None):
+	'''Returns the replacement list of the function-like Macro macro with
+	the arguments args substituted.  Arguments are fully expanded before
+	substitution unless they are operands of # or ##.  Every token of the
+	result has macroHistory added to its hide-set.  names is passed on to
+	rescanTokens when the arguments are expanded.
+	'''
+	def rawText(param):
+		if param in rawArgs:
+			return ''.join(t.string for t in rawArgs[param])
+		return ''
+	
+	def expandedArg(param):
+		if param not in expandedArgs:
+			arg = rescanTokens(rawArgs.get(param, []), d, 0, names)
+			expandedArgs[param] = [t if t.value.isspace() else
+					Token(t.value, t.string, 1, hideSetUnion(t.macroHistory, macroHistory)) for t in arg]
+		return expandedArgs[param]
+	
+	def operandText(operands):
+		s = ''
+		for item in operands:
+			if item[0:4] == '${__':
+				s += rawText(item[4:-1])
+			elif item == '__VA_ARGS__':
+				s += rawText('...')
+			else:
+				s += item
+		return s
+	
+	if macro.name == '__CPP_STRINGIFY__':
+		return lexTokens(stringizeOperand(''.join(t.string for t in args[0])), macroHistory)
+	elif macro.name == '__CPP_MERGE__':
+		return lexTokens(''.join(t.string for t in args[0]), macroHistory)
+	rawArgs = dict(zip(macro.params, args))
+	expandedArgs = {}
+	tokens = []
+	for operation, value in macro.replacement:
+		if operation == 'text':
+			tokens.extend([Token(strand, strand, 1, macroHistory) for strand in value])
+		elif operation == 'arg':
+			tokens.extend(expandedArg(value))
+		elif operation == 'va':
+			if '...' in rawArgs:
+				tokens.extend(expandedArg('...'))
+			else:
+				tokens.extend(lexTokens(value, macroHistory))
+		elif operation == 'stringify':
+			tokens.extend(lexTokens(stringizeOperand(operandText(value).strip()), macroHistory))
+		elif operation == 'comma' and not rawArgs.get('...'):
+			# , ## __VA_ARGS__ removes the comma when there are no variable arguments
+			continue
+		else:
+			tokens.extend(lexTokens(operandText(value), macroHistory))
+	return tokens
+
+
+def rescanTokens(tokens, d, moreLines = 0, names = None):
+	'''Completely replace the macros in a list of tokens.  The replacement
+	of each macro is pushed back onto the unread tokens and rescanned in
+	place, following the hide-set algorithm of the C standard: a token is
+	never expanded by a macro in its own hide-set.  If moreLines is true,
+	the arguments of a function-like macro may continue on the following
+	lines of the file being preprocessed.  If names is a list, the value
+	of every token that is looked up in the macros is appended to it.
+	'''
+	macros = d.macros
+	trace = traceOf(d)
+	if trace and trace.macros is None:
+		trace = None
+	out = []
+	stack = tokens[::-1]
+	while stack:
+		token = stack.pop()
+		name = token.value
+		if names is not None:
+			names.append(name)
+		if name not in macros or name in token.macroHistory:
+			out.append(token)
+			continue
+		macro = macros[name]
+		if trace:
+			start = clock()
+		if macro.params is None:
+			macroHistory = hideSetAdd(token.macroHistory, name)
+			expanded = expandObjectLike(macro, macroHistory, d, names)
+			if expanded is not None:
+				out.extend(expanded)
+				if trace:
+					trace.expansion(name, [t.value for t in expanded], len(macroHistory), start)
+				continue
+			replacement = macro.replacement
+			if replacement is None:
+				replacement = macro.compile()
+			stack.extend([Token(strand, strand, 1, macroHistory) for strand in reversed(replacement)])
+			if trace:
+				trace.expansion(name, replacement, len(macroHistory), start)
+			continue
+		pos = len(stack) - 1
+		while 1:
+			while pos >= 0 and stack[pos].value.isspace():
+				pos -= 1
+			if pos >= 0 or not moreLines or not stack or '\n' not in stack[0].value:
+				break
+			# The line ends with the name of a function-like macro, so its
+			# arguments may start on the next line
+			nl = readLine(d)
+			while nl is not None and nl.isspace():
+				nl = readLine(d)
+			if nl is None:
+				break
+			if nl.lstrip()[0:1] == '(':
+				newTokens = lexTokens(nl)
+				stack[0:0] = newTokens[::-1]
+				pos = len(newTokens) - 1
+			else:
+				# Not an invocation, so preprocess the next line on its own
+				# and append it to this line
+				stack.insert(0, Token('', preprocessLine(nl, d), 0))
+				break
+		if pos < 0 or stack[pos].value != '(':
+			out.append(token)
+			continue
+		if name in ['__CPP_STRINGIFY__', '__CPP_MERGE__']:
+			maxArgs = 1
+		elif macro.variadic:
+			maxArgs = len(macro.params)
+		else:
+			maxArgs = -1
+		collected = collectArguments(stack, pos, d, maxArgs, moreLines)
+		if collected is None:
+			out.append(token)
+			continue
+		args, closingParen = collected
+		macroHistory = token.macroHistory
+		if macroHistory is not closingParen.macroHistory:
+			macroHistory = internHideSet(macroHistory & closingParen.macroHistory)
+		macroHistory = hideSetAdd(macroHistory, name)
+		expanded = substituteArguments(macro, args, macroHistory, d, names)
+		stack.extend(expanded[::-1])
+		if trace:
+			trace.expansion(name, [t.value for t in expanded], len(macroHistory), start)
+	return out
+
+
+def expandObjectLike(macro, macroHistory, d, names = None):
+	'''Returns the complete expansion of the object-like Macro macro as a
+	list of tokens, when the tokens of its replacement have the hide-set
+	macroHistory.  Returns None if the expansion may take arguments from
+	the tokens that follow the macro, in which case the replacement has to
+	be rescanned in place.  Expansions are kept in d.expansions along with
+	the generations of every name examined while making them, and are
+	reused while those generations are unchanged.  The tokens of the
+	returned list are shared and must not be changed.  If names is a list,
+	the names the expansion depends on are appended to it.
+	'''
+	key = (macro.name, macroHistory)
+	entry = d.expansions.get(key)
+	if entry is not None:
+		dependencies, tokens = entry
+		if d.unchanged(dependencies):
+			if names is not None and tokens is not None:
+				names.extend([name for name, generation in dependencies])
+			return tokens
+	if d.expansionDepth > 100:
+		return None
+	replacement = macro.replacement
+	if replacement is None:
+		replacement = macro.compile()
+	found = [macro.name]
+	d.expansionDepth += 1
+	try:
+		tokens = rescanTokens([Token(strand, strand, 1, macroHistory) for strand in replacement], d, 0, found)
+	finally:
+		d.expansionDepth -= 1
+	macros = d.macros
+	for token in tokens:
+		name = token.value
+		if name in macros and macros[name].params is not None and name not in token.macroHistory:
+			# A function-like macro that was not invoked, which may be
+			# followed by its arguments where this macro is used
+			tokens = None
+			break
+	if len(d.expansions) > 10000:
+		d.expansions.clear()
+	d.expansions[key] = (d.dependencies(found), tokens)
+	if names is not None and tokens is not None:
+		names.extend(found)
+	return tokens
+
+
 def expandLine(s, d):
 	'''Performs macro expansion on string s according to the definition
-	dictionary d
+	dictionary d, which is copied into a Definitions object if it is a
+	plain dict.  If d['__CPP_legacy__'] is defined, the original engine
+	that retokenizes the whole line after each replacement is used instead.
 	'''
-	tokens, unbalancedParens = tokenize(s, d)
-	outtoken = expandTokens(s, d, tokens, unbalancedParens)
-	return ''.join(h.string for h in outtoken)
+	d = definitions(d)
+	if '__CPP_legacy__' in d:
+		tokens, unbalancedParens = tokenize(s, d)
+		outtoken = expandTokens(s, d, tokens, unbalancedParens)
+		return ''.join(h.string for h in outtoken)
+	return ''.join(h.string for h in rescanTokens(lexTokens(s), d, 1))
 
 
 def isCNumber(s):
@@ -529,15 +900,16 @@ def isCNumber(s):
 		5: signed long long
 		6: unsigned long long
 	'''
-	m = integers.search(s)
+	m = integers.search(s) or hexnumbers.search(s)
 	if m:
 		if 'U' in m.group(2).upper():
 			n, size = cast_unsigned(s)
 			return size*2, n
-	base = 0
-	if not m:
-		m = hexnumbers.search(s)
-		base = 16
+		n = integerValue(m.group(1) )
+		if n >= 1 << 63:
+			# Too large for long long
+			return 6, n
+		return 1, n
 	if not m:
 		m = charconstant.search(s)
 		if m:
@@ -558,6 +930,18 @@ def isCNumber(s):
 		return 0, s
 
 
+def integerValue(s):
+	'''Returns the value of the digits of a decimal, octal or hexadecimal
+	integer constant, without its suffix
+	'''
+	digits = s.lstrip('+-')
+	if digits[:2] in ['0x', '0X']:
+		return long(s, 16)
+	if len(digits) > 1 and digits[0] == '0':
+		return long(s, 8)
+	return long(s)
+
+
 def cast_unsigned(s):
 	'''Convert a string of a numerical constant with the unsigned specifier to
 	a positive python number.  Returns that number and the size specifier
@@ -567,16 +951,16 @@ def cast_unsigned(s):
 	import ctypes
 	s = s.strip()
 	longs = s.upper().count('L')
-	s = s.rstrip('uUlL')
+	s = integerValue(s.rstrip('uUlL') )
 	if longs == 0:
 		size = 1
-		n = ctypes.c_uint(long(s) )
+		n = ctypes.c_uint(s)
 	elif longs == 1:
 		size = 2
-		n = ctypes.c_ulong(long(s) )
+		n = ctypes.c_ulong(s)
 	elif longs == 2:
 		size = 3
-		n = ctypes.c_ulonglong(long(s) )
+		n = ctypes.c_ulonglong(s)
 	else:
 		raise ValueError('Invalid number: %s' % s)
 	return n.value, size
@@ -604,9 +988,11 @@ def cast_unsigned2(n, intType):
 def defined_op(name, d):	return long(name in d)
 def not_op(left, right):	return long(not right)
 def bnot_op(left, right):	return ~right
+def neg_op(left, right):	return -right
+def pos_op(left, right):	return right
 def mul_op(left, right):	return left * right
-def div_op(left, right):	return left // right
-def mod_op(left, right):	return left % right
+def div_op(left, right):	return long(div_trunc(left, right) )
+def mod_op(left, right):	return left - right * div_trunc(left, right)
 def add_op(left, right):	return left + right
 def sub_op(left, right):	return left - right
 def bshiftr_op(left, right):	return left >> right
@@ -620,116 +1006,195 @@ def ne_op(left, right):	return long(left != right)
 def band_op(left, right):	return left & right
 def bxor_op(left, right):	return left ^ right
 def bor_op(left, right):	return left | right
-def land_op(left, right):	return long(left and right and 1)
-def lor_op(left, right):	return long((left or right) and 1)
-
-def def_op_simple(iterator, r, d, t):
-	# Returns an integer rather than a tuple
-	ans, token = evaluate(iterator, r, d, 70, 0, t)
-	return long(ans in d)
-
-def pnot_op_simple(iterator, r, d, t):
-	# Returns an integer rather than a tuple
-	ans, token = evaluate(iterator, r, d, 60, 0, t)
-	return long(not ans)
-
-
-def neg_op(iterator, l,r, d,t):
-	ans, token = evaluate(iterator, r, d, 60, 0, t)
-	return -ans, token
 
-def paren_op(iterator, l,r, d,t):
-	ans, token = evaluate(iterator, r, d, 0, 0, t)
-	if token == ')':
-		try:
-			token = next(iterator)
-		except StopIteration:
-			token = ''
-			pass
+def div_trunc(left, right):
+	# C division truncates toward zero
+	q = abs(left) // abs(right)
+	if (left < 0) != (right < 0):
+		return -q
+	return q
+
+# Tables used to compile #if expressions: binding power of each binary
+# operator (?: binds loosest and groups to the right), and the functions
+# applying the binary and unary operators
+binaryPrecedence = {'*':50, '/':50, '%':50, '+':47, '-':47, '>>':46,
+		'<<':46, '>':45, '>=':45, '<':45, '<=':45, '==':44, '!=':44,
+		'&':43, '^':42, '|':41, '&&':40, '||':30, '?':20}
+binaryOperators = {'*':mul_op, '/':div_op, '%':mod_op, '+':add_op,
+		'-':sub_op, '>>':bshiftr_op, '<<':bshiftl_op, '>':gt_op, '>=':ge_op,
+		'<':lt_op, '<=':le_op, '==':eq_op, '!=':ne_op, '&':band_op,
+		'^':bxor_op, '|':bor_op}
+unaryOperators = {'!':not_op, '~':bnot_op, '-':neg_op, '+':pos_op}
+comparisonOperators = frozenset(['>', '>=', '<', '<=', '==', '!='])
+shiftOperators = frozenset(['>>', '<<'])
+
+# Compiled #if expressions, keyed by their tuple of tokens
+compiledExpressions = {}
+
+
+def compileExpression(tokens):
+	'''Compile a list of tokens forming a constant expression, in which
+	defined and all identifiers have already been replaced by numbers,
+	into a function returning the value of the expression and its integer
+	type (the first value returned by isCNumber)
+	'''
+	pos = [0]
+	
+	def nextToken():
+		if pos[0] >= len(tokens):
+			raise SyntaxError('Unexpected end of expression: %s' % ' '.join(tokens) )
+		pos[0] += 1
+		return tokens[pos[0] - 1]
+	
+	def expect(token):
+		t = nextToken()
+		if t != token:
+			raise SyntaxError('Expected %s but found %s' % (token, t) )
+	
+	def parseOperand():
+		t = nextToken()
+		if t == '(':
+			inner = parseBinary(1)
+			expect(')')
+			return inner
+		if t in unaryOperators:
+			return compileUnary(unaryOperators[t], parseOperand() )
+		intType, value = isCNumber(t)
+		if not intType:
+			raise SyntaxError('Unexpected token in expression: %s' % t)
+		result = (value, intType)
+		return lambda: result
+	
+	def parseBinary(minPrecedence):
+		left = parseOperand()
+		while pos[0] < len(tokens):
+			t = tokens[pos[0]]
+			p = binaryPrecedence.get(t, 0)
+			if p < minPrecedence:
+				break
+			pos[0] += 1
+			if t == '?':
+				middle = parseBinary(1)
+				expect(':')
+				left = compileConditional(left, middle, parseBinary(p) )
+			else:
+				left = compileBinary(t, left, parseBinary(p + 1) )
+		return left
+	
+	function = parseBinary(1)
+	if pos[0] != len(tokens):
+		raise SyntaxError('Unexpected token in expression: %s' % tokens[pos[0]])
+	return function
+
+
+def compileUnary(op, operand):
+	'''Returns a function applying the unary operator function op'''
+	if op == not_op:
+		return lambda: (long(not operand()[0]), 1)
+	def unary():
+		value, intType = operand()
+		return cast_unsigned2(op(None, value), intType), intType
+	return unary
+
+
+def compileBinary(t, left, right):
+	'''Returns a function applying the binary operator t to the results of
+	the functions left and right.  The operands are converted to unsigned
+	numbers if either one is unsigned, and && and || only evaluate the
+	right operand when needed.
+	'''
+	if t == '&&':
+		return lambda: (long(left()[0] != 0 and right()[0] != 0), 1)
+	if t == '||':
+		return lambda: (long(left()[0] != 0 or right()[0] != 0), 1)
+	op = binaryOperators[t]
+	if t in shiftOperators:
+		def binary():
+			value, intType = left()
+			return cast_unsigned2(op(value, right()[0]), intType), intType
+	elif t in comparisonOperators:
+		def binary():
+			l, leftType = left()
+			r, rightType = right()
+			intType = max(leftType, rightType)
+			return op(cast_unsigned2(l, intType), cast_unsigned2(r, intType) ), 1
 	else:
-		raise SyntaxError('Unexpected token: %s' % token)
-	return ans, token
-
-
-def def_op(iterator, r, d,t):
-	ans, token = evaluate(iterator, r, d, 70,0,t)
-	return long(ans in d), token
-
-def pnot_op(iterator, r, d, t):
-	ans, token = evaluate(iterator, r, d, 60,0,t)
-	return long(not ans), token
-
-def pbnot_op(iterator, r, d, t):
-	ans, token = evaluate(iterator, r, d, 60,0,t)
-	return ~ans, token
-
-
-def evaluate(iterator, token='', d = {}, rightPrecedence = 0,
-		stopCalculating = 0, intType = 0):
-	'''Top-down parser for calculating the value of conditional expressions'''
-	if isinstance(iterator, list):
-		iterator = iter(iterator)
-	operators = {'defined': lambda l,r: def_op_simple(iterator, r, d, 0),
-			'*':mul_op, '!': lambda l,r: pnot_op_simple(iterator, r, d, 0),
-			'/': div_op, '%':mod_op, '+': add_op, '-':sub_op, '>>':bshiftr_op,
-			'<<':bshiftl_op, '>':gt_op, '>=':ge_op, '<':lt_op, '<=':le_op,
-			'==':eq_op, '!=':ne_op, '&':band_op, '^':bxor_op, '|':bor_op,
-			'&&':land_op, '||':lor_op}
-	precedence = {'defined': 70, '!':60, '~':60, '*':50,
-			'/':50, '%':50, '+':47, '-':47, '>>':46,
-			'<<':46, '>':45, '>=':45, '<':45, '<=':45,
-			'==':44, '!=':44, '&':43, '^':42, '|':41,
-			'&&':40, '||':20, '':0 }
-	prefix = {'defined': lambda l,r,t: def_op(iterator, r, d,t),
-			'!': lambda l,r,t: pnot_op(iterator, r, d,t),
-			'~': lambda l,r,t: pbnot_op(iterator, r, d,t), 
-			'+': lambda l,r,t: evaluate(iterator, r, d, 60, 0, t),
-			'-': lambda l,r,t: neg_op(iterator, l,r,d,t),
-			'(': lambda l,r,t: paren_op(iterator, l,r,d,t) }
-	defaultPrefix = lambda key: lambda l,r,t: (key, '')
-	
-	updateExpression = 0
-	if token == '':
-		for item in iterator:
-			intType, token = isCNumber(item)
-			break
-	left = token
-	
-	for item in iterator:
-		t = token
-		itype, token = isCNumber(item)
-		if t == '&&' and left == 0:
-			stopCalculating = 1
-		if t == '||' and left != 0:
-			left = 1
-			stopCalculating = 1
-		if updateExpression:
-			if t in ['&&', '||'] and precedence.get(t,0) == rightPrecedence:
-				p = rightPrecedence - 1
+		def binary():
+			l, leftType = left()
+			r, rightType = right()
+			intType = max(leftType, rightType)
+			value = op(cast_unsigned2(l, intType), cast_unsigned2(r, intType) )
+			return cast_unsigned2(value, intType), intType
+	return binary
+
+
+def compileConditional(condition, iftrue, iffalse):
+	'''Returns a function evaluating condition ? iftrue : iffalse'''
+	def conditional():
+		if condition()[0]:
+			return iftrue()
+		return iffalse()
+	return conditional
+
+
+def evaluate(tokens, d = None):
+	'''Returns the value of a constant expression given as a list of
+	tokens.  If the dict d is given, defined NAME and defined(NAME) are
+	replaced by 1 if NAME is in d, and any other identifier is replaced by
+	0.  The compiled form of each distinct expression is kept for later
+	calls.
+	'''
+	if d is not None:
+		tokens = replaceIdentifiers(tokens, d, 1)
+	key = tuple(tokens)
+	function = compiledExpressions.get(key)
+	if function is None:
+		if len(compiledExpressions) > 10000:
+			compiledExpressions.clear()
+		function = compiledExpressions[key] = compileExpression(key)
+	return function()[0]
+
+
+def replaceIdentifiers(tokens, d, allIdentifiers = 0):
+	'''Returns the list of tokens with defined NAME and defined(NAME)
+	replaced by 1 or 0 depending on whether NAME is in the dict d.  If
+	allIdentifiers is true, any other identifier is replaced by 0, along
+	with its argument list if it is followed by one.
+	'''
+	out = []
+	idx = 0
+	while idx < len(tokens):
+		t = tokens[idx]
+		idx += 1
+		if t == 'defined':
+			if tokens[idx:idx+1] == ['(']:
+				name = tokens[idx+1:idx+2]
+				if tokens[idx+2:idx+3] != [')']:
+					raise SyntaxError('Missing ) after defined')
+				idx += 3
 			else:
-				p = precedence.get(t,0)
-			tmp, token = evaluate(iterator, token, d, p, stopCalculating, itype)
-			if not stopCalculating:
-				if t not in ['<<', '>>']:
-					if intType > itype:
-						if intType > 0:
-							tmp = cast_unsigned2(tmp, intType)
-					elif itype > intType:
-						if itype > 0:
-							left = cast_unsigned2(left, itype)
-				left = operators[t](left, tmp)
+				name = tokens[idx:idx+1]
+				idx += 1
+			if not name:
+				raise SyntaxError('Expected a macro name after defined')
+			if not isIdentifier(name[0]):
+				# A macro that expanded to defined NAME had NAME replaced too
+				log.warning('Invalid use of defined: defined %s' % name[0])
+			out.append(str(defined_op(name[0], d) ) )
+		elif allIdentifiers and isIdentifier(t):
+			if tokens[idx:idx+1] == ['(']:
+				parenBalance = 1
+				idx += 1
+				while idx < len(tokens) and parenBalance:
+					if tokens[idx] == '(':
+						parenBalance += 1
+					elif tokens[idx] == ')':
+						parenBalance -= 1
+					idx += 1
+			out.append('0')
 		else:
-			left, tmp = prefix.get(t, defaultPrefix(t))(t, token, itype)
-			if tmp != '':
-				token = tmp
-			if rightPrecedence < precedence.get(token,0):
-				updateExpression = 1
-				continue
-			else:
-				break
-		if rightPrecedence >= precedence.get(token,0):
-			break
-	return left, token
+			out.append(t)
+	return out
 
 
 def isIdentifier(s):
@@ -742,58 +1207,458 @@ def isIdentifier(s):
 	return 1
 
 
+def expressionTokens(s):
+	'''Returns the preprocessing tokens of the string s without whitespace'''
+	return [t for t in ppTokenList.findall(s) if not t.isspace()]
+
+
 def parseIfDirective(s, d):
-	'''Evaluates the conditional expression for #if and #elif directives'''
-	s = anyDirective.sub(r'\2', s)
-	s = re.sub(r'defined\s*\((.*?)\)', r'defined \1', s)
-	strands = tokenList.findall(s)
-	expansion = []
-	keepMacros = 0
-	for item in strands:
-		if keepMacros:
-			expansion.append(item)
-			keepMacros = 0
-		elif item == 'defined':
-			keepMacros = 1
-			expansion.append(item)
-		else:
-			if isIdentifier(item):
-				if item in d:
-					tt = expandLine(item,d)
-				else:
-					tt = '0'
-				expansion.append(tt)
+	'''Evaluates the conditional expression for #if and #elif directives.
+	If d is a Definitions object, the value of each expression is kept in
+	d.conditions with the generations of the names it depends on, and
+	reused while they are unchanged.  The hits and misses are counted in
+	the conditionCacheHits and conditionCacheMisses statistics.
+	'''
+	trace = traceOf(d)
+	if trace is None:
+		return ifDirectiveValue(s, d)
+	start = clock()
+	value = ifDirectiveValue(s, d)
+	trace.add('conditionals', start, s)
+	return value
+
+
+def ifDirectiveValue(s, d):
+	'''Returns the value of the #if or #elif directive s; see
+	parseIfDirective
+	'''
+	s = anyDirective.sub(r'\2', s).strip()
+	if not isinstance(d, Definitions) or '__CPP_legacy__' in d:
+		return conditionValue(s, d)
+	stats = d.get('__CPP_stats__')
+	entry = d.conditions.get(s)
+	if entry is not None and d.unchanged(entry[0]):
+		if stats is not None:
+			stats['conditionCacheHits'] += 1
+		return entry[1]
+	if stats is not None:
+		stats['conditionCacheMisses'] += 1
+	names = identifiers.findall(s)
+	value = conditionValue(s, d, names)
+	if len(d.conditions) > 10000:
+		d.conditions.clear()
+	d.conditions[s] = (d.dependencies(names), value)
+	return value
+
+
+def conditionValue(s, d, names = None):
+	'''Returns 1 if the expression s of an #if or #elif directive is
+	true, otherwise returns 0.  If names is a list, the names examined
+	while expanding macros are appended to it.
+	'''
+	tokens = replaceIdentifiers(expressionTokens(s), d)
+	for t in tokens:
+		if t in d and isIdentifier(t):
+			# Expand the macros, then look for defined again in case a
+			# macro expanded to it
+			if '__CPP_legacy__' in d:
+				s = expandLine(' '.join(tokens), d)
 			else:
-				expansion.append(item)
-	expandedStrands = tokenList.findall(''.join(expansion))
-	ret, t = evaluate(expandedStrands, '', d)
-	if ret != 0:
-		ret = 1	
-	return ret
+				s = ''.join(h.string for h in rescanTokens(lexTokens(' '.join(tokens)), definitions(d), 0, names) )
+			tokens = expressionTokens(s)
+			break
+	if evaluate(tokens, d) != 0:
+		return 1
+	return 0
 
 
 def calculateValue(s):
 	'''Calculates the value of the input string'''
-	strands = tokenList.findall(s)
-	ret, t = evaluate(strands, '', {})
-	return ret
+	return evaluate(expressionTokens(s) )
 
 
 def skipToEndif(d):
 	'''Ignores the rest of the conditional expression'''
-	while 1:
-		s = getNextLine(d)
-		mm = condDirective.search(s)
-		if mm:
-			if mm.group(1) == 'endif':
-				return
+	try:
+		skipGroup(d, 0)
+	except StopIteration:
+		raise SyntaxError('Missing #endif in ' + d['__FILE__'])
+
+
+def skipGroup(d, stopAtElse = 1):
+	'''Skips the lines of a conditional group that is not processed,
+	including any nested groups, and returns the #endif directive that
+	ends it, or the #else or #elif directive if stopAtElse is true, as
+	returned by getNextLine.  The current position should follow the
+	directive that starts the group or one of its branches.
+	'''
+	trace = d.preprocessor.trace
+	if trace:
+		startTime = clock()
+	f = d.preprocessor.files[-1]
+	start = f.position
+	if f.branches is None:
+		f.findConditionals()
+	i = f.branches.get(start - 1)
+	if i is None:
+		# The group does not end, or the directive was not the last line read
+		i = findBranch(f, start)
+	while not stopAtElse and condDirective.match(f.lines[i]).group(1) != 'endif':
+		j = f.branches.get(i)
+		if j is None:
+			# The group does not end
+			j = findBranch(f, i + 1)
+		i = j
+	f.position = i
+	d['__LINE__'] = str(long(d['__LINE__']) + f.lineEnds[i] - f.lineEnds[start])
+	if trace:
+		trace.add('conditionals', startTime)
+	return getNextLine(d)
+
+
+def findBranch(f, start):
+	'''Returns the index of the first #else, #elif or #endif directive of
+	the source file f after line start that is not in a nested group
+	'''
+	conditionals = f.conditionals
+	k = bisect.bisect_left(conditionals, start)
+	depth = 0
+	while k < len(conditionals):
+		i = conditionals[k]
+		k += 1
+		directive = condDirective.match(f.lines[i]).group(1)
+		if directive in ['if', 'ifdef', 'ifndef']:
+			depth += 1
+		elif depth == 0:
+			return i
+		elif directive == 'endif':
+			depth -= 1
+	f.position = len(f.lines)
+	raise StopIteration
+
+
+class Macro(object):
+	'''The definition of a macro.  An object-like macro has kind 'object'
+	and its replacement text in text.  A function-like macro has kind
+	'function', its parameter names in params, with '...' last if variadic
+	is true, and its replacement list in expansion, in the format of the
+	__CPP_expansion__ dict described in defineMacro.  usedParams,
+	stringified and pasted are the parameters that appear on their own,
+	as operands of # and as operands of ## in the replacement list.
+	replacement is the precompiled form of the replacement used during
+	expansion: the token strings of an object-like macro, which are found
+	when it is first expanded, or a list of (operation, value) pairs.
+	A macro is shared by copies of the definitions, so it is replaced
+	rather than changed when it is redefined.
+	'''
+	__slots__ = ('name', 'kind', 'text', 'params', 'variadic', 'expansion',
+			'replacement', 'usedParams', 'stringified', 'pasted')
+	
+	def __init__(self, name, text = None, params = None, expansion = None):
+		self.name = name
+		self.text = text
+		self.params = params
+		self.expansion = expansion
+		self.replacement = None
+		if params is None:
+			self.kind = 'object'
+			self.variadic = 0
+			self.usedParams = self.stringified = self.pasted = frozenset()
+		else:
+			self.kind = 'function'
+			self.variadic = params[-1:] == ['...']
+			self.compile()
+	
+	def compile(self):
+		'''Sets and returns the replacement attribute'''
+		if self.params is None:
+			self.replacement = ppTokenList.findall(self.text)
+			return self.replacement
+		def operandParams(operands, found):
+			for item in operands:
+				if item[0:4] == '${__':
+					found.add(item[4:-1])
+				elif item == '__VA_ARGS__':
+					found.add('...')
+		
+		replacement = []
+		usedParams = set()
+		stringified = set()
+		pasted = set()
+		expansion = self.expansion
+		idx = 0
+		while idx < len(expansion):
+			item = expansion[idx]
+			idx += 1
+			if isinstance(item, list):
+				operandParams(item, pasted)
+				replacement.append(('paste', item) )
+			elif item[0:2] == '${':
+				usedParams.add(item[2:-1])
+				replacement.append(('arg', item[2:-1]) )
+			elif item == '__VA_ARGS__' and '...' in self.params:
+				usedParams.add('...')
+				replacement.append(('va', item) )
+			elif item in ['__CPP_STRINGIFY__', '__CPP_MERGE__'] and idx < len(expansion) and isinstance(expansion[idx], list):
+				operands = expansion[idx]
+				idx += 1
+				if item == '__CPP_STRINGIFY__':
+					operandParams(operands, stringified)
+					replacement.append(('stringify', operands) )
+				else:
+					operandParams(operands, pasted)
+					if operands[0].strip() == ',' and operands[1:] == ['__VA_ARGS__']:
+						replacement.append(('comma', operands) )
+					else:
+						replacement.append(('paste', operands) )
+			elif replacement and replacement[-1][0] == 'text':
+				replacement[-1][1].extend(ppTokenList.findall(item) )
 			else:
-				skipToEndif(d)
+				replacement.append(('text', ppTokenList.findall(item) ) )
+		self.usedParams = frozenset(usedParams)
+		self.stringified = frozenset(stringified)
+		self.pasted = frozenset(pasted)
+		self.replacement = replacement
+		return replacement
+	
+	def __repr__(self):
+		if self.params is None:
+			return 'Macro(' + repr(self.name) + ', ' + repr(self.text) + ')'
+		return ('Macro(' + repr(self.name) + ', params=' + repr(self.params)
+				+ ', expansion=' + repr(self.expansion) + ')')
+
 
-def translateMacros(macros):
+class MacroView(MutableMapping):
+	'''The __CPP_arguments__ or __CPP_expansion__ dict of a Definitions
+	object, mapping the name of each function-like macro to its params or
+	expansion attribute.  Setting an item defines a function-like macro
+	and deleting one undefines the macro.
+	'''
+	def __init__(self, definitions, attribute):
+		self.definitions = definitions
+		self.attribute = attribute
+	
+	def __getitem__(self, name):
+		macro = self.definitions.macros.get(name)
+		if macro is None or macro.params is None:
+			raise KeyError(name)
+		return getattr(macro, self.attribute)
+	
+	def __setitem__(self, name, value):
+		macro = self.definitions.macros.get(name)
+		if macro is None or macro.params is None:
+			params, expansion = [], []
+		else:
+			params, expansion = macro.params, macro.expansion
+		if self.attribute == 'params':
+			params = value
+		else:
+			expansion = value
+		self.definitions.setMacro(Macro(name, params=params, expansion=expansion) )
+	
+	def __delitem__(self, name):
+		self[name]
+		del self.definitions[name]
+	
+	def __iter__(self):
+		return iter([name for name, macro in self.definitions.macros.items() if macro.params is not None])
+	
+	def __len__(self):
+		return len(list(iter(self) ) )
+	
+	def __repr__(self):
+		return repr(dict(self.items() ) )
+
+
+class Definitions(dict):
+	'''The defines dict used while preprocessing.  It holds the same keys
+	and values as the dict described in defineMacro and can be used in
+	the same way, but it also keeps each macro as a Macro object in the
+	dict macros, so expansion needs a single lookup per identifier.  The
+	__CPP_arguments__ and __CPP_expansion__ keys are MacroView objects.
+	Any other key that is not a string or callable is preprocessor state.
+	A plain dict passed to preprocess is converted to a Definitions object,
+	and updated with its final contents at the end of the call.
+	
+	generations counts the times each name has been defined or undefined.
+	expansions holds the expansions of object-like macros made by
+	expandObjectLike, and conditions the values of the #if and #elif
+	expressions found by parseIfDirective; each is only used while the
+	generations of the names it depends on are unchanged.  preprocessor is
+	the Preprocessor using the definitions, which holds the files being read.
+	'''
+	viewKeys = {'__CPP_arguments__': 'params', '__CPP_expansion__': 'expansion'}
+	
+	def __init__(self, defines = None):
+		dict.__init__(self)
+		self.macros = {}
+		self.generations = {}
+		self.expansions = {}
+		self.conditions = {}
+		self.expansionDepth = 0
+		self.preprocessor = None
+		for key, attribute in self.viewKeys.items():
+			dict.__setitem__(self, key, MacroView(self, attribute) )
+		if defines:
+			self.update(defines)
+	
+	def changed(self, name):
+		'''Records that the macro name has been defined or undefined'''
+		self.generations[name] = self.generations.get(name, 0) + 1
+	
+	def dependencies(self, names):
+		'''Returns the current generations of the identifiers in the list
+		names, as a list of (name, generation) pairs
+		'''
+		generations = self.generations
+		return [(name, generations.get(name, 0) ) for name in set(names)
+				if name[0:1] == '_' or name[0:1].isalpha()]
+	
+	def unchanged(self, dependencies):
+		'''Returns 1 if none of the names in a list returned by the
+		dependencies method has been defined or undefined since
+		'''
+		generations = self.generations
+		for name, generation in dependencies:
+			if generations.get(name, 0) != generation:
+				return 0
+		return 1
+	
+	def setMacro(self, macro):
+		'''Defines the macro given as a Macro object'''
+		if macro.params is None:
+			dict.__setitem__(self, macro.name, macro.text)
+		else:
+			dict.__setitem__(self, macro.name, callable)
+		self.macros[macro.name] = macro
+		self.changed(macro.name)
+	
+	def __setitem__(self, key, value):
+		if isinstance(value, stringTypes):
+			dict.__setitem__(self, key, value)
+			self.macros[key] = Macro(key, value)
+			self.changed(key)
+			return
+		if key in self.viewKeys:
+			view = dict.__getitem__(self, key)
+			if value is not view:
+				for name in value:
+					view[name] = value[name]
+			return
+		dict.__setitem__(self, key, value)
+		if value == callable:
+			macro = self.macros.get(key)
+			if macro is None or macro.params is None:
+				self.macros[key] = Macro(key, params=[], expansion=[])
+				self.changed(key)
+		elif self.macros.pop(key, None) is not None:
+			self.changed(key)
+	
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		if self.macros.pop(key, None) is not None:
+			self.changed(key)
+	
+	def pop(self, key, *default):
+		if self.macros.pop(key, None) is not None:
+			self.changed(key)
+		return dict.pop(self, key, *default)
+	
+	def popitem(self):
+		key, value = dict.popitem(self)
+		if self.macros.pop(key, None) is not None:
+			self.changed(key)
+		return key, value
+	
+	def setdefault(self, key, default = None):
+		if key not in self:
+			self[key] = default
+		return self[key]
+	
+	def update(self, *args, **kwargs):
+		for other in args + (kwargs,):
+			if isinstance(other, Definitions):
+				for key, value in other.items():
+					if key not in self.viewKeys:
+						dict.__setitem__(self, key, value)
+				self.macros.update(other.macros)
+				for name in other.macros:
+					self.changed(name)
+				continue
+			if not hasattr(other, 'keys'):
+				other = dict(other)
+			arguments = other.get('__CPP_arguments__', {})
+			expansion = other.get('__CPP_expansion__', {})
+			for key in other.keys():
+				value = other[key]
+				if key in self.viewKeys:
+					continue
+				elif value == callable and key in arguments:
+					self.setMacro(Macro(key, params=arguments[key], expansion=expansion.get(key, []) ) )
+				else:
+					self[key] = value
+	
+	def clear(self):
+		dict.clear(self)
+		self.macros.clear()
+		self.expansions.clear()
+		self.conditions.clear()
+		for key, attribute in self.viewKeys.items():
+			dict.__setitem__(self, key, MacroView(self, attribute) )
+	
+	def copy(self):
+		return Definitions(self)
+	
+	def asDict(self):
+		'''Returns the contents as a dict in the format described in
+		defineMacro, without references to this object
+		'''
+		r = dict(self)
+		arguments = {}
+		expansion = {}
+		for name, macro in self.macros.items():
+			if macro.params is not None:
+				arguments[name] = macro.params
+				expansion[name] = macro.expansion
+		r.update(__CPP_arguments__=arguments, __CPP_expansion__=expansion)
+		return r
+	
+	def __reduce__(self):
+		return (Definitions, (self.asDict(),) )
+
+
+def storeMacro(d, macro):
+	'''Defines the macro given as a Macro object in the defines dict d,
+	which is either a Definitions object or a dict in the format described
+	in defineMacro
+	'''
+	if isinstance(d, Definitions):
+		d.setMacro(macro)
+	elif macro.params is None:
+		d[macro.name] = macro.text
+	else:
+		d[macro.name] = callable
+		if '__CPP_arguments__' not in d:
+			d.update(__CPP_expansion__={}, __CPP_arguments__={})
+		d['__CPP_arguments__'][macro.name] = macro.params
+		d['__CPP_expansion__'][macro.name] = macro.expansion
+
+
+def definitions(d):
+	'''Returns d if it is a Definitions object, or else a Definitions
+	object holding a copy of the contents of the dict d
+	'''
+	if isinstance(d, Definitions):
+		return d
+	return Definitions(d)
+
+def translateMacros(macros, names=None):
+	'''Returns a dict of the values of the macros, or only of those named in
+	names if it is given'''
+	macros = definitions(macros)
 	r = {}
-	for item in macros:
-		if item.startswith('__CPP_'):
+	for item in (macros if names is None else names):
+		if item.startswith('__CPP_') or item not in macros:
 			continue
 		'''Completely translating the macros into usable objects would require
 		a C interpreter, which is beyond the current scope of this module.
@@ -881,18 +1746,16 @@ def defineMacro(s, d):
 	Object-like macros:
 		#define MACRO definition
 		d['MACRO']: 'definition'
+	If d is a Definitions object, the macro is also stored in d.macros as a
+	Macro object.
 	'''
 	s = anyDirective.sub(r'\2', s)
 	definedParts = defineArgs.findall(s)[0]
 	if definedParts[1]:
 		# function-like macro
-		d[definedParts[0]] = callable
 		args = definedParts[1][1:-1].split(',')
 		for nn, arg in enumerate(args):
 			args[nn] = arg.strip()
-		if '__CPP_arguments__' not in d:
-			d.update(__CPP_expansion__={}, __CPP_arguments__={})
-		d['__CPP_arguments__'][definedParts[0]] = args
 		strands = re.findall(r'".*?[^\\]"|""|\w+|##|#|[^"\w#]+', definedParts[2] )
 		foundHash = 0
 		mergeArgCount = 0
@@ -912,6 +1775,11 @@ def defineMacro(s, d):
 				while pos >= 0 and strands[pos].isspace():
 					strands[pos] = ''
 					pos -= 1
+				if foundHash:
+					# Leave out the whitespace before a further ## of a chain
+					operands = strands[foundHash-1]
+					while operands and operands[-1].isspace():
+						operands.pop()
 				if strands[pos][0:2] == '${':
 					strands[idx] = ['${__' + strands[pos][2:-1] + '}']
 				else:
@@ -928,13 +1796,17 @@ def defineMacro(s, d):
 				pos = idx + 1
 				while pos < len(strands) and strands[pos].isspace():
 					pos += 1
-				if pos < len(strands) and strands[pos] in args:
+				if pos < len(strands) and (strands[pos] in args or
+						strands[pos] == '__VA_ARGS__' and '...' in args):
 					strands[idx] = '__CPP_STRINGIFY__'
 					pos = idx + 1
 					while pos < len(strands) and strands[pos].isspace():
 						strands[pos] = ''
 						pos += 1
-					strands[pos] = ['${__' + strands[pos] + '}']
+					if strands[pos] == '__VA_ARGS__':
+						strands[pos] = [strands[pos] ]
+					else:
+						strands[pos] = ['${__' + strands[pos] + '}']
 			elif foundHash:
 				if item in args:
 					strands[foundHash-1].append( '${__' + item + '}')
@@ -944,14 +1816,25 @@ def defineMacro(s, d):
 					strands[idx] = ''
 			elif item in args:
 				strands[idx] = '${' + item + '}'
-		d['__CPP_expansion__'][definedParts[0]] = [t for t in strands if t != '']
+		storeMacro(d, Macro(definedParts[0], params=args,
+				expansion=[t for t in strands if t != ''] ) )
 	else:
-		d[definedParts[0]] = definedParts[2]
+		storeMacro(d, Macro(definedParts[0], definedParts[2]) )
 
 
-def preprocessConditional(m, matchedDirective, d):
-	'''Preprocess a group of lines starting with #if, #ifdef, or #ifndef'''
-	p = ''
+def preprocessConditional(m, matchedDirective, d, elseBranches = None):
+	'''Preprocess a group of lines starting with #if, #ifdef, or #ifndef.
+	If elseBranches is a list, the #else and #elif directives belonging to
+	the group are appended to it.
+	'''
+	return ''.join(iterPreprocessConditional(m, matchedDirective, d, elseBranches) )
+
+
+def iterPreprocessConditional(m, matchedDirective, d, elseBranches = None):
+	'''Return a generator yielding the preprocessed lines of a group
+	starting with #if, #ifdef, or #ifndef; see preprocessConditional
+	'''
+	trace = traceOf(d)
 	# decide whether to parse the following lines
 	condition = 0
 	if matchedDirective == 'ifdef':
@@ -970,40 +1853,50 @@ def preprocessConditional(m, matchedDirective, d):
 	ns = ''
 	takeElse = not condition
 	while 1:
-			ns = getNextLine(d)
+			try:
+				if condition:
+					ns = getNextLine(d)
+				else:
+					ns = skipGroup(d)
+			except StopIteration:
+				raise SyntaxError('Missing #endif in ' + d['__FILE__'])
 			mm = anyDirective.search(ns)
 			if mm:
 				mmDirective = mm.group(1)
+				if trace and mmDirective in ['else', 'elif', 'endif']:
+					trace.directive(mmDirective)
 			else:
 				mmDirective = None
 			if mmDirective == 'endif':
 				break
+			if elseBranches is not None and mmDirective in ['else', 'elif']:
+				elseBranches.append(mmDirective)
 			if condition:
 				if mmDirective in ['else', 'elif']:
 					condition = 0
 					skipToEndif(d)
+					if trace:
+						trace.directive('endif')
 					break
 				else:
-					ns = preprocessLine(ns, d)
-					p = p + ns
+					for l in iterPreprocessLine(ns, d):
+						yield l
 			elif mmDirective == 'else':
 				if takeElse:
 					condition = 1
 				else:
 					skipToEndif(d)
+					if trace:
+						trace.directive('endif')
 					break
 			elif mmDirective == 'elif':
 				condition = parseIfDirective(ns, d)
 				if condition:
 					takeElse = 0
 					ns = anyDirective.sub(r'#if \2', ns)
-					ns = preprocessLine(ns, d)
-					p = p + ns
+					for l in iterPreprocessLine(ns, d):
+						yield l
 					break
-			elif mmDirective in ['if', 'ifdef', 'ifndef']:
-				skipToEndif(d)
-				# No break here because there is one more endif to find after this call
-	return p
 
 
 def preprocessLine(s, d):
@@ -1012,10 +1905,26 @@ def preprocessLine(s, d):
 	should contain any defined macros which should be used to substitute
 	values into the expression given in s.
 	'''
-	p = ''
+	if not isinstance(d, Definitions):
+		defines = Definitions(d)
+		try:
+			return ''.join(iterPreprocessLine(s, defines) )
+		finally:
+			d.clear()
+			d.update(defines.asDict() )
+	return ''.join(iterPreprocessLine(s, d) )
+
+
+def iterPreprocessLine(s, d):
+	'''Return a generator yielding the output of preprocessLine; a
+	conditional group or an included file is yielded line by line
+	'''
 	m = anyDirective.search(s)
 	if m:
 		matchedDirective = m.group(1)
+		trace = traceOf(d)
+		if trace and matchedDirective:
+			trace.directive(matchedDirective)
 		if matchedDirective == 'define':
 			defineMacro(s,d)
 		elif matchedDirective == 'undef':
@@ -1023,7 +1932,8 @@ def preprocessLine(s, d):
 			if s in d:
 				d.pop(s)
 		elif matchedDirective in ['if', 'ifdef', 'ifndef']:
-			p = preprocessConditional(m, matchedDirective, d)
+			for l in iterPreprocessConditional(m, matchedDirective, d):
+				yield l
 		elif matchedDirective == 'warning':
 			log.warning(d['__FILE__'] + ':' + d['__LINE__'] + ': ' + anyDirective.sub(r'\2', s) )
 		elif matchedDirective == 'error':
@@ -1035,9 +1945,10 @@ def preprocessLine(s, d):
 			if not (name[0] in ['"', '<'] and name[-1] in ['"', '>']):
 				name = expandLine(name, d).strip()
 			if name[0] == '"' and name[-1] == '"':
-				currentDir = os.path.dirname(os.path.abspath(d['__CPP_fileobject__'].name ) )
+				currentDir = os.path.dirname(os.path.abspath(d.preprocessor.files[-1].name) )
 				path.insert(0, currentDir)
-			p = preprocess(name[1:-1], d, path, encoding=d['__CPP_encoding__'])
+			for l in d.preprocessor.include(name[1:-1], path):
+				yield l
 		elif matchedDirective == 'line':
 			# Change line number and source file seen by preprocessor
 			s = expandLine(s[m.end(1):], d)
@@ -1046,98 +1957,435 @@ def preprocessLine(s, d):
 			if t.group(2):
 				d['__FILE__'] = t.group(2)
 		elif matchedDirective == 'pragma':
-			# Ignore pragma directives
-			pass
+			# Ignore pragma directives other than #pragma once
+			if m.group(2) == 'once' and '__CPP_once__' in d:
+				d['__CPP_once__'].add(d.preprocessor.files[-1].name)
 		elif matchedDirective == None:
 			# Ignore empty directives
 			pass
 		else:
 			raise IOError(s)
+	elif '__CPP_directivesonly__' in d:
+		# Only the directives are processed, so text lines are dropped
+		pass
+	elif '__CPP_legacy__' in d or containsMacro(s, d):
+		if '__CPP_stats__' in d:
+			d['__CPP_stats__']['linesExpanded'] += 1
+		trace = traceOf(d)
+		if trace:
+			start = clock()
+			l = expandLine(s, d)
+			trace.add('expansion', start, s)
+			yield l
+		else:
+			yield expandLine(s, d)
 	else:
-		p = expandLine(s, d)
-	return p
+		# Nothing on the line can expand, so it is output unchanged
+		if '__CPP_stats__' in d:
+			d['__CPP_stats__']['linesPassedThrough'] += 1
+		yield s
+
+
+def containsMacro(s, d):
+	'''Returns 1 if the string s contains an identifier that is a macro in
+	the defines dict d, otherwise returns 0.  Identifiers within strings and
+	numbers are included, so s may not expand even if 1 is returned.
+	'''
+	macros = getattr(d, 'macros', d)
+	for name in identifiers.findall(s):
+		if name in macros:
+			return 1
+	return 0
 
 
 def getNextLine(d):
-	''' Get the next line of the file to preprocess.  Strip out all
-	comments and combine continued lines into a single line.
+	''' Get the next line of the file to preprocess, with all comments
+	removed and continued lines combined into a single line.
 	Returns the next line to preprocess as a a string.
 	'''
-	f = d['__CPP_fileobject__']
-	linesAdvanced = 1
-	s = next(f)
-	p = ''
-	foundLineContinuation = lineContinuation.search(s)
-	while foundLineContinuation:
-		linesAdvanced += 1
-		s = s[:foundLineContinuation.start()] + next(f)
-		foundLineContinuation = lineContinuation.search(s)
-	foundQuote = 0
-	continueParsingLine = 1
+	f = d.preprocessor.files[-1]
+	i = f.position
+	if i >= len(f.lines):
+		raise StopIteration
+	f.position = i + 1
+	d['__LINE__'] = str(long(d['__LINE__']) + f.lineEnds[i+1] - f.lineEnds[i])
+	return f.lines[i]
+
+
+class SourceFile(object):
+	'''A source file that is read and decoded at once and split into
+	logical lines, used as the file object of the preprocessor.  lines[i]
+	ends on physical line lineEnds[i+1], and position is the index of the
+	next line to preprocess.  conditionals holds the indices of the lines
+	that are conditional directives, and branches maps the index of each
+	#if, #ifdef, #ifndef, #elif or #else line to the index of the next
+	#elif, #else or #endif line of the same group.  Both are None until
+	findConditionals is called.  The time taken to read the file is added
+	to trace if it is a Trace.
+	'''
+	def __init__(self, name, encoding, trace = None):
+		self.name = name
+		self.closed = 0
+		self.position = 0
+		if trace:
+			start = clock()
+		with open(name, 'rb') as f:
+			data = f.read()
+		text = decodeSource(data, encoding)
+		if trace:
+			trace.add('io', start, name)
+			start = clock()
+		self.lines, self.lineEnds = splitLogicalLines(text)
+		if trace:
+			trace.add('comments', start, name)
+		self.conditionals = None
+		self.branches = None
+	
+	def findConditionals(self):
+		'''Sets conditionals and branches'''
+		match = condDirective.match
+		found = [(i, m.group(1)) for i, m in
+				((i, match(s)) for i, s in enumerate(self.lines) if '#' in s) if m]
+		self.conditionals = [i for i, directive in found]
+		self.branches = {}
+		groups = []
+		for i, directive in found:
+			if directive in ['if', 'ifdef', 'ifndef']:
+				groups.append(i)
+			elif groups:
+				self.branches[groups[-1]] = i
+				if directive == 'endif':
+					groups.pop()
+				else:
+					groups[-1] = i
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *args):
+		self.close()
+	
+	def close(self):
+		self.closed = 1
+		self.lines = []
+		self.conditionals = None
+		self.branches = None
+
+
+def decodeSource(data, encoding):
+	'''Returns the bytes data decoded as text in the given encoding.  Pure
+	ASCII data skips the codec when the encoding is compatible with ASCII.
+	'''
+	if u'#\n'.encode(encoding) == b'#\n':
+		try:
+			return data.decode('ascii')
+		except UnicodeDecodeError:
+			pass
+	return data.decode(encoding, 'warn')
+
+
+def splitLogicalLines(text):
+	'''Split text into logical lines: continued lines are joined, and
+	comments are removed (replaced by a space when they end on the same
+	line).  Returns the list of lines and the list of the physical line
+	numbers where each line ends, after a leading 0.
+	'''
+	physical = text.splitlines(True)
+	count = len(physical)
+	# Only lines with a backslash or a slash need more than copying
+	special = [i for i, s in enumerate(physical) if '/' in s or '\\' in s]
+	if not special:
+		return physical, list(range(count + 1) )
+	lines = []
+	lineEnds = [0]
+	n = 0
+	for i in special:
+		if i < n:
+			continue
+		lines.extend(physical[n:i])
+		lineEnds.extend(range(n + 1, i + 1) )
+		s, n = logicalLine(physical, i)
+		lines.append(s)
+		lineEnds.append(n)
+	lines.extend(physical[n:])
+	lineEnds.extend(range(n + 1, count + 1) )
+	return lines, lineEnds
+
+
+def logicalLine(physical, n):
+	'''Returns the logical line starting at physical[n] without comments,
+	along with the index of the physical line that follows it
+	'''
+	count = len(physical)
+	s = physical[n]
+	n += 1
+	if '\\' in s:
+		s, n = joinContinuedLines(s, physical, n)
+	if not '/' in s:
+		return s, n
 	pos = 0
-	while continueParsingLine:
-		continueParsingLine = 0
-		removedChars = 0
-		blockDelimiters = blockDelimiter.finditer(s, pos)
-		for match in blockDelimiters:
-			if foundQuote:
-				if match.group(1) == '"' and match.string[match.start()-1] != '\\':
-					foundQuote = 0
-				continue
-			if match.group(1) == '"':
-				foundQuote = 1
+	while 1:
+		m = commentOrQuote.search(s, pos)
+		if not m:
+			break
+		t = m.group()
+		if t == '//':
+			s = s[:m.start()]
+			if len(s) > 0:
+				s += os.linesep
+			break
+		elif t == '/*':
+			end = s.find('*/', m.end() )
+			if end >= 0:
+				s = s[:m.start()] + ' ' + s[end+2:]
+				pos = m.start() + 1
 				continue
-			if match.group(2) == '//':
-				s = s[:match.start()]
-				if len(s) > 0:
-					s += os.linesep
-				break
-			elif match.group(2) == '/*':
-				blockCommentStart = match.start() - removedChars
-				p = s[:blockCommentStart]
-				# Find block comment end markers
-				#   If found, remove the comment portion and search for more comments on the current line
-				#   If not found, get a new line and search for the end marker on that line
-				for mate in blockDelimiters:
-					if mate.group(2) == '*/':
-						match = mate
-						s = p + ' ' + match.string[match.end():]
-						removedChars = match.end() - blockCommentStart - 1
-						break
-				else:
-					# Executed when the for loop terminates by exhausting blockDelimiters,
-					# so the search should continue on the next line of the file
-					nextLine = ''
-					commentEndPos = -1
-					while commentEndPos == -1:
-						linesAdvanced += 1
-						nextLine = next(f)
-						foundLineContinuation = lineContinuation.search(nextLine)
-						while foundLineContinuation:
-							linesAdvanced += 1
-							nextLine = nextLine[:foundLineContinuation.start()] + next(f)
-							foundLineContinuation = lineContinuation.search(nextLine)
-						commentEndPos = nextLine.find('*/')
-					s = p + nextLine[commentEndPos+2:]
-					pos = blockCommentStart
-					continueParsingLine = 1
-				
-	d['__LINE__'] = str(long(d['__LINE__']) + linesAdvanced)
-	return s
+			# The comment ends on a following line
+			p = s[:m.start()]
+			s = ''
+			while n < count:
+				nextLine = physical[n]
+				n += 1
+				if '\\' in nextLine:
+					nextLine, n = joinContinuedLines(nextLine, physical, n)
+				end = nextLine.find('*/')
+				if end >= 0:
+					s = nextLine[end+2:]
+					break
+			s = p + s
+			pos = m.start()
+		else:
+			pos = m.end()
+	return s, n
 
 
-def findFile(filename, paths):
+def joinContinuedLines(s, physical, n):
+	'''Join the line s with the following lines physical[n:] while it ends
+	with a backslash.  Returns the joined line and the index of the next
+	physical line.
+	'''
+	foundLineContinuation = lineContinuation.search(s)
+	while foundLineContinuation and n < len(physical):
+		s = s[:foundLineContinuation.start()] + physical[n]
+		n += 1
+		foundLineContinuation = lineContinuation.search(s)
+	return s, n
+
+
+def defaultHeaderPaths(times = None):
+	'''Returns the list of the standard directories to search for headers;
+	times is passed to directoryTime
+	'''
+	if sys.platform.startswith('win'):
+		key = (os.environ.get('INCLUDE'),)
+	else:
+		key = (os.environ.get('CPATH'), os.environ.get('C_INCLUDE_PATH'),
+				directoryTime('/usr/include', times) )
+	headerPaths = systemHeaderPaths.get(key)
+	if headerPaths is not None:
+		return headerPaths
+	headerPaths = []
+	if sys.platform.startswith('win'):
+		try:
+			headerPaths.extend(os.environ['INCLUDE'].split(';'))
+		except KeyError:
+			pass
+	else:
+		for var in ['CPATH', 'C_INCLUDE_PATH']:
+			try:
+				headerPaths.extend(os.environ[var].split(':'))
+			except KeyError:
+				pass
+		otherHeaderPaths = ['/usr/local/include', '/usr/include']
+		target = platform.machine()
+		targetSpecificHeaders = '/usr/include/' + target
+		if not os.path.exists(targetSpecificHeaders):
+			targetSpecificHeaders = None
+			incl = os.listdir('/usr/include')
+			for item in incl:
+				if item.startswith(target) and os.path.isdir('/usr/include/' + item):
+					targetSpecificHeaders = '/usr/include/' + item
+					break
+		if targetSpecificHeaders:
+			otherHeaderPaths.append(targetSpecificHeaders)
+		headerPaths.extend(otherHeaderPaths)
+	systemHeaderPaths.clear()
+	systemHeaderPaths[key] = headerPaths
+	return headerPaths
+
+
+def directoryTime(path, times = None):
+	'''Returns the modification time of the directory path, or None if it
+	does not exist.  If the dict times is given, the times found are kept
+	there and each directory is only examined once; a Preprocessor uses one
+	dict for each call.
+	'''
+	if times is not None and path in times:
+		return times[path]
+	try:
+		t = os.stat(path).st_mtime
+	except OSError:
+		t = None
+	if times is not None:
+		times[path] = t
+	return t
+
+
+def findFile(filename, paths, times = None):
 	'''Search for filename in the list of given paths
-	and return the first existing filename
+	and return the first existing filename.  The result, including a file
+	that is not found, is remembered until one of the directories looked
+	in changes; times is passed to directoryTime.
+	'''
+	key = (filename, tuple(paths), os.getcwd() )
+	entry = resolvedIncludes.get(key)
+	if entry is not None:
+		fullpath, directories, modified = entry
+		if [directoryTime(p, times) for p in directories] != modified:
+			entry = None
+	if entry is None:
+		fullpath = None
+		directories = []
+		modified = []
+		for p in paths:
+			candidate = os.path.join(p, filename)
+			directory = os.path.dirname(candidate) or os.curdir
+			directories.append(directory)
+			modified.append(directoryTime(directory, times) )
+			if os.path.exists(candidate):
+				fullpath = candidate
+				break
+		if len(resolvedIncludes) > 10000:
+			resolvedIncludes.clear()
+		resolvedIncludes[key] = (fullpath, directories, modified)
+	if fullpath is None:
+		raise IOError('File ' + filename + ' not found.')
+	return fullpath
+
+
+def definitionsFingerprint(d):
+	'''Returns a string identifying the macros defined in the dict d'''
+	items = []
+	for key in sorted(d):
+		value = d[key]
+		if key in ['__LINE__', '__FILE__', '__DATE__', '__TIME__']:
+			continue
+		if value == callable:
+			value = (d['__CPP_arguments__'].get(key), d['__CPP_expansion__'].get(key))
+		elif not isinstance(value, stringTypes):
+			# Preprocessor state rather than a macro
+			continue
+		items.append((key, value))
+	items.append(sorted(d.get('__CPP_once__', []) ) )
+	return repr(items)
+
+
+def fileDigest(filename):
+	'''Returns the SHA-1 digest of the contents of a file'''
+	with open(filename, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+
+def cacheEntryName(cache, filename, headerPaths, encoding, defines):
+	'''Returns the name of the file in the cache directory holding the
+	output of preprocessing filename with the given search path, encoding,
+	and initial definitions
+	'''
+	key = repr((cacheVersion, sys.version_info[:2], platform.machine(),
+			platform.system(), os.path.abspath(os.curdir), filename,
+			headerPaths, encoding, definitionsFingerprint(defines) ))
+	return os.path.join(cache, hashlib.sha1(key.encode('utf8')).hexdigest() + '.ppcache')
+
+
+def loadCachedOutput(entryName):
+	'''Returns the preprocessed text and final definitions stored in a cache
+	entry, or None if the entry is missing, unreadable, or any file it was
+	made from has changed
+	'''
+	try:
+		import cPickle as pickle
+	except ImportError:
+		import pickle
+	try:
+		with open(entryName, 'rb') as f:
+			entry = pickle.load(f)
+		for dependency, digest in entry['dependencies']:
+			if fileDigest(dependency) != digest:
+				return None
+	except Exception:
+		return None
+	try:
+		# Mark the entry as recently used
+		os.utime(entryName, None)
+	except OSError:
+		pass
+	return entry['output'], entry['defines']
+
+
+def storeCachedOutput(entryName, output, defines):
+	'''Write a cache entry, then remove the least recently used entries
+	while the cache directory is larger than cacheSizeLimit bytes.  The
+	entry is written to a temporary file and renamed into place, so
+	concurrent readers and writers never see a partial entry.
 	'''
-	for p in paths:
-		fullpath = os.path.join(p, filename)
-		if os.path.exists(fullpath):
-				return fullpath
-	raise IOError('File ' + filename + ' not found.')
+	try:
+		import cPickle as pickle
+	except ImportError:
+		import pickle
+	import tempfile
+	cache = os.path.dirname(entryName)
+	state = defines.asDict()
+	tempName = None
+	try:
+		dependencies = [(dependency, fileDigest(dependency)) for dependency in defines['__CPP_dependencies__'] ]
+		entry = dict(output=output, defines=state, dependencies=dependencies)
+		if not os.path.isdir(cache):
+			try:
+				os.makedirs(cache)
+			except OSError:
+				# Another process may have created the directory
+				if not os.path.isdir(cache):
+					raise
+		fd, tempName = tempfile.mkstemp(suffix='.tmp', dir=cache)
+		with os.fdopen(fd, 'wb') as f:
+			pickle.dump(entry, f, 2)
+		getattr(os, 'replace', os.rename)(tempName, entryName)
+	except Exception as e:
+		log.info('Unable to write cache entry %s: %s' % (entryName, e))
+		if tempName:
+			try:
+				os.remove(tempName)
+			except OSError:
+				pass
+		return
+	
+	entries = []
+	totalSize = 0
+	now = time.time()
+	for name in os.listdir(cache):
+		entryPath = os.path.join(cache, name)
+		try:
+			st = os.stat(entryPath)
+			if name.endswith('.tmp') and now - st.st_mtime > 3600:
+				# Left behind by a writer that did not finish
+				os.remove(entryPath)
+		except OSError:
+			continue
+		if name.endswith('.ppcache'):
+			entries.append((st.st_mtime, st.st_size, entryPath))
+			totalSize += st.st_size
+	entries.sort()
+	for mtime, size, entryPath in entries:
+		if totalSize <= cacheSizeLimit:
+			break
+		try:
+			os.remove(entryPath)
+		except OSError:
+			pass
+		totalSize -= size
 
 
-def preprocess(filename, defines = None, path = '', callback = None, encoding=None):
+def preprocess(filename, defines = None, path = '', callback = None, encoding=None, cache=None, trace=None):
 	'''Preprocess a file.  The file to be processed is passed in as a
 	string in the filename argument; if the file is not in the current or
 	parent directory, it may be looked for in the standard include
@@ -1149,79 +2397,330 @@ def preprocess(filename, defines = None, path = '', callback = None, encoding=No
 	given.  Pass in a string as the encoding parameter to dictate the input
 	encoding, such as 'utf8'.  Returns the unicode string representing the
 	preprocessed file.
+	
+	A file is not read again if it contained #pragma once, or if it is
+	entirely enclosed in #ifndef NAME ... #endif and NAME is defined.
+	Counters describing the last call are left in defines['__CPP_stats__'],
+	such as filesRead and includesSkipped (the reads avoided this way).
+	Lines without any macro name are output without macro expansion, and
+	counted in linesPassedThrough; the other lines are counted in
+	linesExpanded.  The values of #if and #elif expressions are reused
+	while the macros they use are unchanged, as counted in
+	conditionCacheHits and conditionCacheMisses.
+	
+	If cache names a directory, the output and the final definitions are
+	saved there and reused by later calls with the same file name, search
+	path, encoding and initial definitions, as long as none of the files
+	read has changed.
+	
+	If trace is a Trace object, the time taken by each file and by each
+	phase of preprocessing is recorded in it.
+	
+	If callback is given, it is called with each piece of the output as it
+	is produced and an empty string is returned; see also iter_preprocess.
 	'''
-	headerPaths = []
-	if sys.platform.startswith('win'):
-		if path:
-			headerPaths = path
-		if defines and '__CPP_path__' in defines:
-			headerPaths.extend(defines['__CPP_path__'])
-		else:
-			try:
-				headerPaths.extend(os.environ['INCLUDE'].split(';'))
-			except KeyError:
-				pass
-	else:
-		if path:
-			headerPaths = path
-		if defines and '__CPP_path__' in defines:
-			headerPaths.extend(defines['__CPP_path__'])
-		else:
-			for var in ['CPATH', 'C_INCLUDE_PATH']:
+	lines = iter_preprocess(filename, defines, path, encoding, cache, trace)
+	if callback != None:
+		for l in lines:
+			callback(l)
+		return ''
+	return ''.join(lines)
+
+
+def iter_preprocess(filename, defines = None, path = '', encoding=None, cache=None, trace=None):
+	'''Preprocess a file like preprocess, but return a generator yielding
+	the output one line at a time as it is produced, so the whole
+	preprocessed file is never held in memory.  The defines dict holds the
+	final macro definitions once the generator is exhausted.
+	'''
+	preprocessor = Preprocessor(defines, path, encoding, cache, trace)
+	if defines is None or defines is preprocessor.defines:
+		return preprocessor.iter_preprocess(filename)
+	return iterUpdatingDefinitions(preprocessor.iter_preprocess(filename), preprocessor.defines, defines)
+
+
+def iterUpdatingDefinitions(lines, definitions, defines):
+	'''Yields the lines, then stores the contents of the Definitions
+	object definitions in the plain dict defines
+	'''
+	try:
+		for l in lines:
+			yield l
+	finally:
+		defines.clear()
+		defines.update(definitions.asDict() )
+
+
+# The clock used to time preprocessing
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def traceOf(d):
+	'''Returns the Trace of the Preprocessor using the defines dict d, or
+	None if it is not traced
+	'''
+	preprocessor = getattr(d, 'preprocessor', None)
+	return preprocessor and preprocessor.trace
+
+
+class Trace(object):
+	'''Timings of preprocessing, recorded when passed as the trace argument
+	of preprocess or Preprocessor.  files maps each file read to the
+	number of times it was read, and the seconds spent in it including and
+	excluding the files it includes.  directives counts each directive
+	processed.  phases holds the seconds spent reading and decoding files
+	(io), removing comments and joining continued lines (comments),
+	evaluating #if and #elif and skipping groups (conditionals), and
+	expanding macros in text lines (expansion).  Each file read and each
+	step that took at least threshold seconds is kept as an event for
+	chromeTrace.  The time taken by the caller between the lines yielded
+	by iter_preprocess is included in the time of the files.
+	
+	If macros is true, the macros attribute is a dict mapping the name of
+	each macro expanded to a dict holding the number of expansions, the
+	number of tokens they produced, the greatest depth of nested macro
+	expansions they were found at, and the seconds spent expanding them,
+	under the keys expansions, tokens, depth and seconds.  The time of an
+	object-like macro includes the macros within it; that of a
+	function-like macro covers collecting and substituting its arguments,
+	and its result is rescanned afterwards.  The macros within an
+	expansion reused from Definitions.expansions are not counted again.
+	Only the default expansion engine is measured.  Otherwise, macros is
+	None.
+	'''
+	def __init__(self, threshold = 0.0005, macros = 0):
+		self.threshold = threshold
+		self.macros = {} if macros else None
+		self.start = clock()
+		self.files = {}
+		self.directives = {}
+		self.phases = dict(io=0.0, comments=0.0, conditionals=0.0, expansion=0.0)
+		# (name, category, start, duration) of the events kept
+		self.events = []
+		# [name, start, seconds in included files] of the files being read
+		self.stack = []
+	
+	def add(self, phase, start, detail = None):
+		'''Records the time since start as spent in phase; detail names
+		the step in the event kept if it took long enough
+		'''
+		duration = clock() - start
+		self.phases[phase] += duration
+		if duration >= self.threshold:
+			self.events.append((' '.join((detail or phase).split() )[:100], phase, start, duration) )
+	
+	def directive(self, name):
+		'''Counts one directive'''
+		self.directives[name] = self.directives.get(name, 0) + 1
+	
+	def expansion(self, name, tokens, depth, start):
+		'''Records an expansion of the macro name into the list of token
+		strings tokens, at the given depth, that began at start
+		'''
+		duration = clock() - start
+		entry = self.macros.get(name)
+		if entry is None:
+			entry = self.macros[name] = dict(expansions=0, tokens=0, depth=0, seconds=0.0)
+		entry['expansions'] += 1
+		entry['tokens'] += len([t for t in tokens if t and not t.isspace()])
+		if depth > entry['depth']:
+			entry['depth'] = depth
+		entry['seconds'] += duration
+	
+	def beginFile(self, name):
+		'''Records that the file name starts being read'''
+		self.stack.append([name, clock(), 0.0])
+	
+	def endFile(self):
+		'''Records that the innermost file being read has ended'''
+		name, start, included = self.stack.pop()
+		duration = clock() - start
+		if self.stack:
+			self.stack[-1][2] += duration
+		entry = self.files.setdefault(name, [0, 0.0, 0.0])
+		entry[0] += 1
+		entry[1] += duration
+		entry[2] += duration - included
+		self.events.append((name, 'file', start, duration) )
+	
+	def chromeTrace(self):
+		'''Returns the events as a JSON string in the Chrome trace event
+		format, which can be loaded in chrome://tracing or Perfetto; the
+		totals are in otherData
+		'''
+		import json
+		pid = os.getpid()
+		events = [dict(name=name, cat=category, ph='X', pid=pid, tid=0,
+				ts=round((start - self.start) * 1e6, 3), dur=round(duration * 1e6, 3) )
+				for name, category, start, duration in sorted(self.events, key=lambda e: (e[2], -e[3]) )]
+		otherData = dict(phases=self.phases, directives=self.directives)
+		if self.macros is not None:
+			otherData['macros'] = self.macros
+		return json.dumps(dict(traceEvents=events, displayTimeUnit='ms', otherData=otherData) )
+	
+	def summary(self, limit = 20):
+		'''Returns the totals as text, with the limit files that took the
+		most time excluding the files they include
+		'''
+		lines = ['Time in phases:']
+		for phase in ['io', 'comments', 'conditionals', 'expansion']:
+			lines.append('  %-14s %9.3fs' % (phase, self.phases[phase]) )
+		lines.append('Directives:')
+		for name, count in sorted(self.directives.items(), key=lambda item: (-item[1], item[0]) ):
+			lines.append('  %-14s %9d' % (name, count) )
+		lines.append('Files by exclusive time (inclusive, exclusive, reads):')
+		files = sorted(self.files.items(), key=lambda item: -item[1][2])
+		for name, (reads, inclusive, exclusive) in files[:limit]:
+			lines.append('  %9.3fs %9.3fs %5d  %s' % (inclusive, exclusive, reads, name) )
+		if len(files) > limit:
+			lines.append('  ... %d more files' % (len(files) - limit) )
+		return os.linesep.join(lines) + os.linesep
+	
+	def macroReport(self, limit = 20, key = 'seconds'):
+		'''Returns the statistics of the limit macros with the greatest
+		value of key, one of the keys of the dicts in macros, as text
+		'''
+		lines = ['Macros by %s (expansions, tokens, depth, seconds):' % key]
+		macros = sorted(self.macros.items(), key=lambda item: (-item[1][key], item[0]) )
+		for name, entry in macros[:limit]:
+			lines.append('  %9d %9d %5d %9.3fs  %s' % (entry['expansions'], entry['tokens'],
+					entry['depth'], entry['seconds'], name) )
+		if len(macros) > limit:
+			lines.append('  ... %d more macros' % (len(macros) - limit) )
+		return os.linesep.join(lines) + os.linesep
+
+
+class Preprocessor(object):
+	'''Preprocesses files, keeping all the state of preprocessing: the
+	macro definitions in the Definitions object defines, the search path
+	and encoding, the stack of the files being read, and the modification
+	times of the directories looked in.  Each call starts from the
+	definitions left by the previous one.  If trace is a Trace object,
+	the timings of preprocessing are recorded in it.  The module functions preprocess
+	and iter_preprocess use a new Preprocessor for each call.
+	
+	A Preprocessor is used by one thread at a time, while Preprocessors
+	holding different definitions can preprocess concurrently.
+	'''
+	def __init__(self, defines = None, path = '', encoding = None, cache = None, trace = None):
+		self.defines = definitions(defines if defines is not None else {})
+		self.defines.preprocessor = self
+		self.path = list(path) if path else []
+		self.encoding = encoding or locale.getpreferredencoding()
+		self.cache = cache
+		self.trace = trace
+		# The search path of the current call, ending with the standard
+		# header directories
+		self.headerPaths = []
+		# The SourceFile objects of the files being read, the innermost last
+		self.files = []
+		# The number of times each file being read includes itself
+		self.includedLevel = {}
+		self.directoryTimes = {}
+	
+	def preprocess(self, filename, callback = None):
+		'''Preprocesses the file filename like the module function
+		preprocess, and returns the output
+		'''
+		lines = self.iter_preprocess(filename)
+		if callback != None:
+			for l in lines:
+				callback(l)
+			return ''
+		return ''.join(lines)
+	
+	def iter_preprocess(self, filename):
+		'''Returns a generator yielding the output of preprocessing the file
+		filename one line at a time, like the module function iter_preprocess
+		'''
+		if self.files:
+			raise ValueError('Already preprocessing ' + self.files[0].name)
+		defines = self.defines
+		# Directories may have changed since the last call
+		self.directoryTimes = {}
+		self.headerPaths = self.path + defaultHeaderPaths(self.directoryTimes)
+		
+		cacheEntry = None
+		if self.cache:
+			cacheEntry = cacheEntryName(self.cache, filename, self.headerPaths, self.encoding, defines)
+			cached = loadCachedOutput(cacheEntry)
+			if cached:
+				output, state = cached
+				defines.clear()
+				defines.update(state)
+				defines['__CPP_stats__'] = dict(filesRead=0, includesSkipped=0,
+						linesExpanded=0, linesPassedThrough=0,
+						conditionCacheHits=0, conditionCacheMisses=0, cacheHits=1)
+				yield output
+				return
+		
+		self.includedLevel = {}
+		defines['__CPP_stats__'] = dict(filesRead=0, includesSkipped=0,
+				linesExpanded=0, linesPassedThrough=0,
+				conditionCacheHits=0, conditionCacheMisses=0)
+		defines['__CPP_dependencies__'] = []
+		if '__CPP_once__' not in defines:
+			defines.update(__CPP_once__=set(), __CPP_includeguards__={})
+		# The output is only kept when it is saved to the cache
+		preprocessedList = []
+		# Relative path names are looked for in the current directory first,
+		# but only for the file named in the call
+		for l in self.include(filename, [os.curdir]):
+			if cacheEntry:
+				preprocessedList.append(l)
+			yield l
+		if cacheEntry:
+			defines['__CPP_stats__']['cacheHits'] = 0
+			storeCachedOutput(cacheEntry, ''.join(preprocessedList), defines)
+	
+	def include(self, filename, path):
+		'''Returns a generator yielding the output of the file filename
+		where it is included, searching the directories in the list path
+		before the search path
+		'''
+		defines = self.defines
+		includeFilePath = findFile(filename, path + self.headerPaths, self.directoryTimes)
+		guard = defines['__CPP_includeguards__'].get(includeFilePath)
+		if includeFilePath in defines['__CPP_once__'] or (guard is not None and guard in defines):
+			defines['__CPP_stats__']['includesSkipped'] += 1
+			return
+		if [f for f in self.files if f.name == includeFilePath]:
+			self.includedLevel[includeFilePath] = self.includedLevel.get(includeFilePath, 0) + 1
+			if self.includedLevel[includeFilePath] > 20:
+				log.error('Recursive include of file ' + includeFilePath + ' detected.')
+				raise ValueError('Recursive include of file ' + includeFilePath + ' detected.')
+		
+		defines['__CPP_stats__']['filesRead'] += 1
+		defines['__CPP_dependencies__'].append(includeFilePath)
+		if self.files:
+			savedLine = defines['__LINE__']
+			savedFilename = defines['__FILE__']
+		if self.trace:
+			self.trace.beginFile(includeFilePath)
+		try:
+			with SourceFile(includeFilePath, self.encoding, self.trace) as f:
+				self.files.append(f)
 				try:
-					headerPaths.extend(os.environ[var].split(':'))
-				except KeyError:
-					pass
-			otherHeaderPaths = ['/usr/local/include', '/usr/include']
-			target = platform.machine()
-			targetSpecificHeaders = '/usr/include/' + target
-			if not os.path.exists(targetSpecificHeaders):
-				targetSpecificHeaders = None
-				incl = os.listdir('/usr/include')
-				for item in incl:
-					if item.startswith(target) and os.path.isdir('/usr/include/' + item):
-						targetSpecificHeaders = '/usr/include/' + item
-						break
-			if targetSpecificHeaders:
-				otherHeaderPaths.append(targetSpecificHeaders)
-			headerPaths.extend(otherHeaderPaths)
-	
-	if not defines or not '__CPP_fileobject__' in defines:
-		if defines == None:
-			defines = dict(__CPP_expansion__={}, __CPP_arguments__={})
-		savedFile = []
-		savedFilename = ''
-		defines['__CPP_filelist__'] = []
-		defines['__CPP_includedlevel__'] = dict()
-		defines['__CPP_path__'] = headerPaths[:]
-		# Enable relative path names by inserting the current directory to the
-		# beginning of headerPaths, but it will not be propagated beyond the
-		# initial call because the path is not saved to the defines variable
-		headerPaths.insert(0, os.curdir)
-	else:
-		savedFile = defines['__CPP_fileobject__']
-		savedLine = defines['__LINE__']
-		savedFilename = defines['__FILE__']
-	
-	includeFilePath = findFile(filename, headerPaths)
-	if includeFilePath in defines['__CPP_filelist__']:
-		if includeFilePath in defines['__CPP_includedlevel__']:
-			defines['__CPP_includedlevel__'][includeFilePath] += 1
-		else:
-			defines['__CPP_includedlevel__'][includeFilePath] = 1
-		if defines['__CPP_includedlevel__'][includeFilePath] > 20:
-			log.error('Recursive include of file ' + includeFilePath + ' detected.')
-			raise ValueError('Recursive include of file ' + includeFilePath + ' detected.')
-	
-	preprocessedList = []
-	if callback == None:
-		callback = preprocessedList.append
-	defines['__CPP_filelist__'].append(includeFilePath)
-	if encoding == None:
-		encoding = locale.getpreferredencoding()
-	defines['__CPP_encoding__'] = encoding
-	with codecs.open(includeFilePath, 'r', encoding=encoding, errors='warn') as f:
-		defines.update(__CPP_fileobject__ = f, __LINE__ = '0',
+					for l in self.iterPreprocessFile(f, filename):
+						yield l
+				finally:
+					self.files.pop()
+				if self.files:
+					defines['__LINE__'] = savedLine
+					defines['__FILE__'] = savedFilename
+		finally:
+			if self.trace:
+				self.trace.endFile()
+		if includeFilePath in self.includedLevel:
+			self.includedLevel[includeFilePath] -= 1
+	
+	def iterPreprocessFile(self, f, filename):
+		'''Returns a generator yielding the output of the SourceFile f,
+		which is the innermost file being read, named filename where it is
+		included
+		'''
+		defines = self.defines
+		defines.update(__LINE__ = '0',
 			__FILE__ = stringify(filename), __DATE__ = '"' + time.strftime('%b %d %Y') + '"',
 			__TIME__ = '"' + time.strftime('%H:%M:%S') + '"', __STDC__ = '1',
 			__STDC_HOSTED__ = '1', __STDC_VERSION__ = '199901L'
@@ -1231,53 +2730,238 @@ def preprocess(filename, defines = None, path = '', callback = None, encoding=No
 			# Remove the leading 0 from days less than 10 (01-09)
 			datestr = datestr[0:5] + ' ' + datestr[6:]
 			defines.update(__DATE__ = datestr)
-		if not '__CPP_arguments__' in defines:
-			defines.update(__CPP_expansion__={}, __CPP_arguments__={})
 		if not '__CPP_STRINGIFY__' in defines:
-			defines.update(__CPP_STRINGIFY__ = callable, __CPP_MERGE__ = callable, _Pragma = callable)
-			defines['__CPP_arguments__'].update(__CPP_STRINGIFY__='__CPP_a__', __CPP_MERGE__ = ['__CPP_a__', '__CPP_b__'], _Pragma = 'x')
-			defines['__CPP_expansion__'].update(__CPP_STRINGIFY__='__CPP_a__', __CPP_MERGE__='__CPP_a__', _Pragma = '')
+			defines.setMacro(Macro('__CPP_STRINGIFY__', params='__CPP_a__', expansion='__CPP_a__') )
+			defines.setMacro(Macro('__CPP_MERGE__', params=['__CPP_a__', '__CPP_b__'], expansion='__CPP_a__') )
+			defines.setMacro(Macro('_Pragma', params='x', expansion='') )
 		
 		# Platform-specific standard macros are defined below
 		if platform.machine() in ['i386', 'i686']:
-			defines['__i386__'] = ''
+			defines['__i386__'] = '1'
 		elif platform.machine() in ['x86_64', 'AMD64']:
-			defines['__x86_64__'] = ''
+			defines['__x86_64__'] = '1'
 		elif platform.machine() in ['ppc', 'PowerPC', 'Power Macintosh']:
 			defines['__ppc__'] = '1'
 		elif platform.machine() in ['ia64']:
 			defines['__ia64__'] = '1'
 		
 		if platform.system() == 'Windows':
-			defines['_WIN32'] = ''
+			defines['_WIN32'] = '1'
 			if sys.maxsize > 2 ** 32:
-				defines['_WIN64'] = ''
+				defines['_WIN64'] = '1'
 		elif platform.system() == 'Darwin':
-			defines['__MACH__'] = ''
-			defines['__APPLE__'] = ''
+			defines['__MACH__'] = '1'
+			defines['__APPLE__'] = '1'
 			defines['TARGET_OS_MAC'] = '1'
 			if '__i386__' in defines:
 				defines['TARGET_CPU_X86'] = '1'
 			elif '__ppc__' in defines:
 				defines['TARGET_CPU_PPC'] = '1'
 		else:
-			defines['__unix__'] = ''
+			defines['__unix__'] = '1'
 		
+		# guardState is 0 before the first line that is not blank, 1 after a
+		# group that may be an include guard, and 2 if the file is not guarded
+		guardState = 0
 		while 1:
 			try:
 				l = getNextLine(defines)
 			except StopIteration:
 				break
-			l = preprocessLine(l, defines)
-			callback(l)
-		if not isinstance(savedFile, list):
-			defines['__CPP_fileobject__'] = savedFile
-			defines['__LINE__'] = savedLine
-			defines['__FILE__'] = savedFilename
-	defines['__CPP_filelist__'].remove(includeFilePath)
-	if includeFilePath in defines['__CPP_includedlevel__']:
-		defines['__CPP_includedlevel__'][includeFilePath] -= 1
-	return ''.join(preprocessedList)
+			if guardState != 2 and l.strip():
+				m = None
+				if guardState == 0:
+					m = includeGuard.search(l)
+				if m:
+					guard = m.group(1) or m.group(2) or m.group(3)
+					elseBranches = []
+					m = anyDirective.search(l)
+					if self.trace:
+						self.trace.directive(m.group(1))
+					for l in iterPreprocessConditional(m, m.group(1), defines, elseBranches):
+						yield l
+					guardState = 2 if elseBranches else 1
+					continue
+				guardState = 2
+			for l in iterPreprocessLine(l, defines):
+				yield l
+		if guardState == 1:
+			defines['__CPP_includeguards__'][f.name] = guard
+
+
+# Keys of the defines dict that only describe a single call to preprocess
+callStateKeys = ['__CPP_stats__', '__CPP_dependencies__']
+
+
+def forkDefinitions(d):
+	'''Returns a Definitions copy of the defines dict d that can be passed
+	to preprocess as a new top-level call and changed without affecting d.
+	The macro definitions themselves are shared, since they are replaced
+	rather than changed; only the dicts and sets holding them are copied.
+	'''
+	r = Definitions(d)
+	for key in callStateKeys:
+		r.pop(key, None)
+	for key, value in list(r.items() ):
+		if isinstance(value, dict):
+			r[key] = dict(value)
+		elif isinstance(value, set):
+			r[key] = set(value)
+	return r
+
+
+class Snapshot(object):
+	'''The preprocessor state after preprocessing some headers: their
+	macros, which of them are include guarded or #pragma once, and their
+	preprocessed output.  The state is never changed; fork returns a
+	defines dict that starts from it.
+	'''
+	def __init__(self, defines, output = ''):
+		self.definitions = forkDefinitions(defines)
+		self.output = output
+	
+	def fork(self, defines = None):
+		'''Returns a new defines dict holding the snapshot state, with the
+		macros in the dict defines added to it
+		'''
+		d = forkDefinitions(self.definitions)
+		if defines:
+			d.update(dict((key, value) for key, value in defines.items() if key not in callStateKeys) )
+		return d
+
+
+def snapshot(filenames, defines = None, path = '', encoding = None):
+	'''Preprocess each of the files in the list filenames in turn, as if
+	they were included one after another, and return a Snapshot of the
+	resulting state.  Pass snapshot.fork() as the defines of later calls
+	to preprocess to start from that state instead of reading the same
+	headers again; files included again are skipped if they are guarded.
+	The arguments are the same as those of preprocess.
+	'''
+	if defines == None:
+		defines = {}
+	output = []
+	for filename in filenames:
+		defines = forkDefinitions(defines)
+		output.append(preprocess(filename, defines, path, encoding=encoding) )
+	return Snapshot(defines, ''.join(output) )
+
+
+# The arguments shared by the files preprocessed in a preprocess_many
+# worker process, set once when the process starts
+poolState = None
+
+
+def initPoolWorker(defines, path, encoding, cache):
+	'''Stores the arguments of preprocess_many in a worker process'''
+	global poolState
+	poolState = (defines, path, encoding, cache)
+
+
+def preprocessCopy(filename, defines, path, encoding, cache):
+	'''Preprocesses filename starting from a copy of defines, and returns
+	the output and the final definitions as a picklable dict
+	'''
+	defines = forkDefinitions(defines)
+	output = preprocess(filename, defines, path, encoding=encoding, cache=cache)
+	return output, defines.asDict()
+
+
+def preprocessPoolFile(filename):
+	'''Preprocesses one of the files of preprocess_many in a worker process'''
+	return preprocessCopy(filename, *poolState)
+
+
+def preprocess_many(filenames, defines = None, path = '', encoding = None, cache = None, jobs = None):
+	'''Preprocess each of the files in the list filenames independently,
+	each starting from the definitions in the dict defines, which is not
+	changed.  Returns a list of (output, defines) pairs in the order of
+	filenames, holding the output and the final definitions of each file.
+	The files are spread across jobs worker processes, or as many as there
+	are CPUs if jobs is None; the initial definitions, search path,
+	encoding and cache are sent to each worker once.  The other arguments
+	are the same as those of preprocess.
+	'''
+	filenames = list(filenames)
+	defines = forkDefinitions(defines or {})
+	if jobs == None:
+		import multiprocessing
+		jobs = multiprocessing.cpu_count()
+	jobs = min(jobs, len(filenames) )
+	if jobs <= 1:
+		return [preprocessCopy(filename, defines, path, encoding, cache) for filename in filenames]
+	import multiprocessing
+	pool = multiprocessing.Pool(jobs, initPoolWorker, (defines, path, encoding, cache) )
+	try:
+		results = pool.map(preprocessPoolFile, filenames, 1)
+	finally:
+		pool.close()
+		pool.join()
+	return results
+
+
+def preprocessDirectives(filename, defines = None, path = '', encoding = None):
+	'''Processes only the directives of filename and the files it
+	includes, without expanding or outputting the other lines, and returns
+	the defines dict holding the final macro definitions.  The arguments
+	are the same as those of preprocess.
+	'''
+	if defines == None:
+		defines = {}
+	defines['__CPP_directivesonly__'] = 1
+	try:
+		for l in iter_preprocess(filename, defines, path, encoding):
+			pass
+	finally:
+		defines.pop('__CPP_directivesonly__', None)
+	return defines
+
+
+def dumpMacros(filename, defines = None, path = '', encoding = None):
+	'''Returns the macros defined after preprocessing filename as
+	#define lines, like cpp -dM.  Only the directives are processed; the
+	defines dict holds the definitions afterwards.
+	'''
+	return stringifyDefinitions(preprocessDirectives(filename, defines, path, encoding) )
+
+
+def dependencies(filename, defines = None, path = '', encoding = None, system = 1):
+	'''Returns the list of files read when preprocessing filename: the file
+	itself followed by the files it includes, in the order they are first
+	read.  Only the directives are processed, so this is much faster than
+	preprocess, and the defines dict holds the final macro definitions
+	afterwards as usual.  If system is false, the included files found in
+	the standard include directories are left out.  The other arguments are
+	the same as those of preprocess.
+	'''
+	defines = preprocessDirectives(filename, defines, path, encoding)
+	systemPaths = []
+	if not system:
+		systemPaths = [os.path.join(os.path.abspath(p), '') for p in defaultHeaderPaths()]
+	files = []
+	for f in defines['__CPP_dependencies__']:
+		f = os.path.normpath(f)
+		if f in files:
+			continue
+		if files and [p for p in systemPaths if os.path.abspath(f).startswith(p)]:
+			continue
+		files.append(f)
+	return files
+
+
+def formatDependencies(target, files, format = 'make'):
+	'''Returns the list of files returned by dependencies as a make rule
+	for the file target if format is 'make', or as a JSON object with the
+	target and the list of files if format is 'json'
+	'''
+	if format == 'json':
+		import json
+		return json.dumps(dict(target=target, dependencies=files), indent=1)
+	elif format != 'make':
+		raise ValueError('Unknown dependency format: %s' % format)
+	def escape(name):
+		return re.sub(r'([\s#])', r'\\\1', name.replace('$', '$$') )
+	return escape(target) + ':' + ''.join(' \\' + os.linesep + '  ' + escape(f) for f in files) + os.linesep
 
 
 log = logging.getLogger(__name__)
@@ -1326,23 +3010,112 @@ def run_cli(argv=None):
 				help='Undefine macro', callback=cli_define, callback_args=(clidefs,) )
 	parser.add_option('-e', dest='encoding',
 			help='Set input file encoding', metavar='CODE')
+	parser.add_option('--legacy-expansion', dest='legacy', action='store_true',
+			help='Use the original macro expansion engine')
+	parser.add_option('--stats', dest='stats', action='store_true',
+			help='Print preprocessor statistics to stderr')
+	parser.add_option('--cache', dest='cache',
+			help='Reuse preprocessed output saved in DIR', metavar='DIR')
+	parser.add_option('--time-trace', dest='timeTrace', action='store_true',
+			help='Print the time taken by each phase and file to stderr')
+	parser.add_option('--time-trace-file', dest='timeTraceFile',
+			help='Write the timings as Chrome trace event JSON to FILE', metavar='FILE')
+	parser.add_option('--macro-stats', dest='macroStats', action='store_true',
+			help='Print the macros that took the most time to expand to stderr')
+	parser.add_option('--macro-stats-sort', dest='macroStatsSort', default='seconds',
+			choices=['expansions', 'tokens', 'depth', 'seconds'],
+			help='Sort the macros by expansions, tokens, depth or seconds (default)', metavar='KEY')
+	parser.add_option('-j', '--jobs', dest='jobs', type='int',
+			help='Preprocess all the FILE arguments using N processes', metavar='N')
+	parser.add_option('--output-dir', dest='outputDir',
+			help='With --jobs, write the output of each FILE to DIR/FILE.i; the names must differ',
+			metavar='DIR')
+	parser.add_option('-d', dest='dump', choices=['M'],
+			help='With -dM, output the final macro definitions instead of the preprocessed text',
+			metavar='M')
+	parser.add_option('-M', '--dependencies', dest='dependencies', action='store_true',
+			help='Output the files included instead of the preprocessed text')
+	parser.add_option('--no-system-dependencies', dest='system', action='store_false',
+			default=True, help='Leave out the files in the standard include directories')
+	parser.add_option('--dependency-format', dest='format', default='make',
+			choices=['make', 'json'], help='Output dependencies as a make rule or as JSON',
+			metavar='make|json')
+	parser.add_option('--dependency-target', dest='target',
+			help='Name the target of the make rule (default FILE.o)', metavar='TARGET')
 	(options, args) = parser.parse_args(argv)
+	trace = None
+	if options.timeTrace or options.timeTraceFile or options.macroStats:
+		if options.jobs or options.dependencies or options.dump:
+			parser.error('--time-trace and --macro-stats cannot be used with --jobs, -M or -dM')
+		trace = Trace(macros=options.macroStats)
+	if options.jobs and (options.dependencies or options.dump):
+		parser.error('--jobs cannot be used with -M or -dM')
+	if options.outputDir:
+		if not options.jobs:
+			parser.error('--output-dir can only be used with --jobs')
+		outputNames = [os.path.join(options.outputDir, os.path.splitext(os.path.basename(filename) )[0] + '.i')
+				for filename in args]
+		for name in outputNames:
+			if outputNames.count(name) > 1:
+				parser.error('Several FILE arguments would be written to ' + name)
+	if options.legacy:
+		clidefs['__CPP_legacy__'] = '1'
 	if options.path:
 		options.path.insert(0, os.getcwd() )
 		path = options.path
 	else:
 		path = [os.getcwd() ]
 	
-	s = preprocess(args[0], defines=clidefs, path=path, encoding=options.encoding)
-	if len(args) > 1:
-		with codecs.open(args[1], 'w', encoding=options.encoding) as f:
-			f.write(s)
+	outputName = len(args) > 1 and args[1]
+	if options.jobs:
+		results = preprocess_many(args, clidefs, path, options.encoding, options.cache, options.jobs)
+		clidefs['__CPP_stats__'] = {}
+		lines = []
+		for i, (output, defines) in enumerate(results):
+			for key, value in defines['__CPP_stats__'].items():
+				clidefs['__CPP_stats__'][key] = clidefs['__CPP_stats__'].get(key, 0) + value
+			if options.outputDir:
+				with codecs.open(outputNames[i], 'w', encoding=options.encoding) as f:
+					f.write(output)
+			else:
+				lines.append(output)
+		outputName = None
+	elif options.dependencies:
+		files = dependencies(args[0], clidefs, path, options.encoding, options.system)
+		target = options.target or os.path.splitext(os.path.basename(args[0]) )[0] + '.o'
+		lines = [formatDependencies(target, files, options.format)]
+	elif options.dump:
+		lines = [dumpMacros(args[0], clidefs, path, options.encoding)]
 	else:
-		try:
-			print(s)
-		except UnicodeEncodeError:
-			sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
-			print(s)
+		lines = iter_preprocess(args[0], defines=clidefs, path=path, encoding=options.encoding,
+				cache=options.cache, trace=trace)
+	if outputName:
+		with codecs.open(outputName, 'w', encoding=options.encoding) as f:
+			for l in lines:
+				f.write(l)
+	elif lines:
+		out = sys.stdout
+		for l in lines:
+			try:
+				out.write(l)
+			except UnicodeEncodeError:
+				out = codecs.getwriter(locale.getpreferredencoding())(getattr(sys.stdout, 'buffer', sys.stdout) )
+				out.write(l)
+		out.write('\n')
+	if options.stats:
+		stats = clidefs['__CPP_stats__']
+		for key in sorted(stats):
+			sys.stderr.write('%s: %s%s' % (key, stats[key], os.linesep) )
+		lines = stats['linesExpanded'] + stats['linesPassedThrough']
+		if lines:
+			sys.stderr.write('passthroughRate: %.3f%s' % (float(stats['linesPassedThrough']) / lines, os.linesep) )
+	if options.timeTrace:
+		sys.stderr.write(trace.summary() )
+	if options.macroStats:
+		sys.stderr.write(trace.macroReport(key=options.macroStatsSort) )
+	if options.timeTraceFile:
+		with open(options.timeTraceFile, 'w') as f:
+			f.write(trace.chromeTrace() )
 	return 0
 
 
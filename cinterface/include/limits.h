@@ -19,7 +19,7 @@
 /* These definitions are convoluted to avoid integer promotion/overflow */
 #define SHRT_MIN (((1 << (__CPP_SHORT_BITS-2)) - 1) *-2 - 2)
 #define SHRT_MAX (((1 << (__CPP_SHORT_BITS-2)) - 1) * 2 + 1)
-#define USHRT_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 4)
+#define USHRT_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 3)
 #define INT_MIN (((1 << (__CPP_INT_BITS-2)) - 1) *-2 - 2)
 #define INT_MAX (((1 << (__CPP_INT_BITS-2)) - 1) * 2 + 1)
 #define UINT_MAX (-1U)
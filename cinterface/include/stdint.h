@@ -65,7 +65,7 @@ typedef unsigned __CPP_8BIT uint_fast8_t;
 
 #define INT8_MIN (((1 << (8-2)) - 1) *-2 - 2)
 #define INT8_MAX (((1 << (8-2)) - 1) * 2 + 1)
-#define UINT8_MAX (((1 << (8-2)) - 1) * 4 + 4)
+#define UINT8_MAX (((1 << (8-2)) - 1) * 4 + 3)
 #define INT_LEAST8_MIN INT8_MIN
 #define INT_LEAST8_MAX INT8_MAX
 #define UINT_LEAST8_MAX UINT8_MAX
@@ -80,25 +80,25 @@ typedef unsigned __CPP_8BIT uint_fast8_t;
 		typedef unsigned short uint_least16_t;
 		#define INT_LEAST16_MIN  (((1 << (__CPP_SHORT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST16_MAX  (((1 << (__CPP_SHORT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST16_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST16_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_INT_BITS >= 16
 		typedef int int_least16_t
 		typedef unsigned int uint_least16_t;
 		#define INT_LEAST16_MIN  (((1 << (__CPP_INT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST16_MAX  (((1 << (__CPP_INT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST16_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST16_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONG_BITS >= 16
 		typedef long int_least16_t
 		typedef unsigned long uint_least16_t;
 		#define INT_LEAST16_MIN  (((1L << (__CPP_LONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST16_MAX  (((1L << (__CPP_LONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST16_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST16_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONGLONG_BITS >= 16
 		typedef long long int_least16_t
 		typedef unsigned long long uint_least16_t;
 		#define INT_LEAST16_MIN  (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST16_MAX  (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST16_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST16_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 3)
 	#else
 		#error No suitable type for int_least16_t
 	#endif
@@ -109,7 +109,7 @@ typedef unsigned __CPP_8BIT uint_fast8_t;
 	typedef unsigned __CPP_16BIT uint_least16_t;
 	#define INT16_MIN (((1 << (16-2)) - 1) *-2 - 2)
 	#define INT16_MAX (((1 << (16-2)) - 1) * 2 + 1)
-	#define UINT16_MAX (((1U << (16-2)) - 1) * 4 + 4)
+	#define UINT16_MAX (((1U << (16-2)) - 1) * 4 + 3)
 #endif
 
 typedef int_least16_t int_fast16_t;
@@ -125,25 +125,25 @@ typedef uint_least16_t uint_fast16_t;
 		typedef unsigned short uint_least32_t;
 		#define INT_LEAST32_MIN (((1 << (__CPP_SHORT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST32_MAX (((1 << (__CPP_SHORT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST32_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST32_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_INT_BITS >= 32
 		typedef int int_least32_t
 		typedef unsigned int uint_least32_t;
 		#define INT_LEAST32_MIN (((1 << (__CPP_INT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST32_MAX (((1 << (__CPP_INT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST32_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST32_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONG_BITS >= 32
 		typedef long int_least32_t
 		typedef unsigned long uint_least32_t;
 		#define INT_LEAST32_MIN (((1L << (__CPP_LONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST32_MAX (((1L << (__CPP_LONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST32_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST32_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONGLONG_BITS >= 32
 		typedef long long int_least32_t
 		typedef unsigned long long uint_least32_t;
 		#define INT_LEAST32_MIN (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST32_MAX (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST32_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST32_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 3)
 	#else
 		#error No suitable type for int_least32_t
 	#endif
@@ -154,7 +154,7 @@ typedef uint_least16_t uint_fast16_t;
 	typedef unsigned __CPP_32BIT uint_least32_t;
 	#define INT32_MIN (((1L << (32-2)) - 1) *-2 - 2)
 	#define INT32_MAX (((1L << (32-2)) - 1) * 2 + 1)
-	#define UINT32_MAX (((1UL << (32-2)) - 1) * 4 + 4)
+	#define UINT32_MAX (((1UL << (32-2)) - 1) * 4 + 3)
 #endif
 
 
@@ -172,25 +172,25 @@ typedef uint_least32_t uint_fast32_t;
 		typedef unsigned short uint_least64_t;
 		#define INT_LEAST64_MIN (((1 << (__CPP_SHORT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST64_MAX (((1 << (__CPP_SHORT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST64_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST64_MAX (((1U << (__CPP_SHORT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_INT_BITS >= 64
 		typedef int int_least64_t
 		typedef unsigned int uint_least64_t;
 		#define INT_LEAST64_MIN (((1 << (__CPP_INT_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST64_MAX (((1 << (__CPP_INT_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST64_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST64_MAX (((1U << (__CPP_INT_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONG_BITS >= 64
 		typedef long int_least64_t
 		typedef unsigned long uint_least64_t;
 		#define INT_LEAST64_MIN (((1L << (__CPP_LONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST64_MAX (((1L << (__CPP_LONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST64_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST64_MAX (((1UL << (__CPP_LONG_BITS-2)) - 1) * 4 + 3)
 	#elif __CPP_LONGLONG_BITS >= 64
 		typedef long long int_least64_t
 		typedef unsigned long long uint_least64_t;
 		#define INT_LEAST64_MIN (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) *-2 - 2)
 		#define INT_LEAST64_MAX (((1LL << (__CPP_LONGLONG_BITS-2)) - 1) * 2 + 1)
-		#define UINT_LEAST64_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 4)
+		#define UINT_LEAST64_MAX (((1ULL << (__CPP_LONGLONG_BITS-2)) - 1) * 4 + 3)
 	#else
 		#error No suitable type for int_least64_t
 	#endif
@@ -201,7 +201,7 @@ typedef uint_least32_t uint_fast32_t;
 	typedef unsigned __CPP_64BIT uint_least64_t;
 	#define INT64_MIN (((1LL << (64-2)) - 1) *-2 - 2)
 	#define INT64_MAX (((1LL << (64-2)) - 1) * 2 + 1)
-	#define UINT64_MAX (((1ULL << (64-2)) - 1) * 4 + 4)
+	#define UINT64_MAX (((1ULL << (64-2)) - 1) * 4 + 3)
 #endif
 
 
@@ -244,7 +244,7 @@ typedef unsigned long long uintptr_t;
 #define UINTPTR_MAX (-1ULL)
 
 /* size_t is unsigned */
-#define SIZE_MAX (((1ULL << (__CPP_SIZE_BITS-2)) - 1) * 4 + 4)
+#define SIZE_MAX (((1ULL << (__CPP_SIZE_BITS-2)) - 1) * 4 + 3)
 
 /* ptrdiff_t is signed */
 #define PTRDIFF_MIN (((1LL << (__CPP_PTRDIFF_BITS-2)) - 1) *-2 - 2)
@@ -256,12 +256,12 @@ typedef unsigned long long uintptr_t;
 
 #ifndef WCHAR_MIN
 /* wchar_t is unsigned */
-#define WCHAR_MAX (((1ULL << (__CPP_WCHAR_BITS-2)) - 1) * 4 + 4)
+#define WCHAR_MAX (((1ULL << (__CPP_WCHAR_BITS-2)) - 1) * 4 + 3)
 #define WCHAR_MIN 0
 #endif
 
 /* wint_t is unsigned */
-#define WINT_MAX (((1ULL << (__CPP_WINT_BITS-2)) - 1) * 4 + 4)
+#define WINT_MAX (((1ULL << (__CPP_WINT_BITS-2)) - 1) * 4 + 3)
 #define WINT_MIN 0
 
 #endif
@@ -3,7 +3,7 @@
 
 #if !defined __CPP_INT_BITS || !defined __CPP_LONG_BITS \
 		|| !defined __CPP_LONGLONG_BITS || !defined __CPP_SHORT_BITS \
-		!defined __CPP_SIZE_BITS
+		|| !defined __CPP_SIZE_BITS
 	#error Missing macro definitions detected
 #endif
 
@@ -134,7 +134,7 @@ size_t wcsrtombs(char * restrict dst, const wchar_t ** restrict src, size_t len,
 
 #ifndef WCHAR_MIN
 	#define WCHAR_MIN 0
-	#define WCHAR_MAX (((1ULL << (__CPP_WCHAR_BITS-2)) - 1) * 4 + 4)
+	#define WCHAR_MAX (((1ULL << (__CPP_WCHAR_BITS-2)) - 1) * 4 + 3)
 #endif
 
 
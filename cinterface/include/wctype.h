@@ -4,7 +4,7 @@
 #if !defined __CPP_INT_BITS || !defined __CPP_LONG_BITS \
 		|| !defined __CPP_LONGLONG_BITS || !defined __CPP_SHORT_BITS \
 		|| !defined __CPP_WCTRANS_BITS || !defined __CPP_WCTYPE_BITS \
-		!defined __CPP_WINT_BITS
+		|| !defined __CPP_WINT_BITS
 	#error Missing macro definitions detected
 #endif
 
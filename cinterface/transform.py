@@ -12,14 +12,19 @@ from __future__ import with_statement
 
 import ctypes
 import ctypes.util
+import fnmatch
+import gc
 import logging
+import itertools
 import os
 import operator
 import pycparser
+from pycparser.ply.lex import LexToken
 # pycparser (https://github.com/eliben/pycparser)
 # is not in the standard library
 import re
 import sys
+import threading
 # Certain functions in this module depend on the pickle or cpp modules,
 # and are imported within those functions
 
@@ -946,6 +951,93 @@ def getNodeTypeName(node):
 		return r + node.name
 
 
+def symbolPattern(symbols):
+	'''Returns a compiled pattern matching the names given by symbols, a
+	glob pattern or a list of them'''
+	if isinstance(symbols, basestringTypes):
+		symbols = [symbols]
+	return re.compile('|'.join(fnmatch.translate(s) for s in symbols) or '(?!)')
+
+
+# The nodes that wrap the type of a declaration
+declarators = (pycparser.c_ast.Decl, pycparser.c_ast.Typedef, pycparser.c_ast.TypeDecl,
+		pycparser.c_ast.PtrDecl, pycparser.c_ast.ArrayDecl, pycparser.c_ast.FuncDecl)
+
+
+def definedNames(node):
+	'''Returns the names defined by the top level declaration node: the
+	name it declares, and the tags and enumeration constants of the types
+	it defines.  A tag is named like 'struct name'.
+	'''
+	if isinstance(node, pycparser.c_ast.FuncDef):
+		node = node.decl
+	names = []
+	if getattr(node, 'name', None):
+		names.append(node.name)
+	nodes = [node]
+	while nodes:
+		node = nodes.pop()
+		while isinstance(node, declarators):
+			node = node.type
+		if isinstance(node, (pycparser.c_ast.Struct, pycparser.c_ast.Union)):
+			if node.decls is not None:
+				if node.name:
+					names.append('%s %s' % (isinstance(node, pycparser.c_ast.Struct) and 'struct' or 'union', node.name))
+				nodes.extend(node.decls)
+		elif isinstance(node, pycparser.c_ast.Enum):
+			if node.values is not None:
+				if node.name:
+					names.append('enum %s' % node.name)
+				names.extend(e.name for e in node.values.enumerators)
+	return names
+
+
+def referencedNames(node):
+	'''Returns the set of the type names, tags and identifiers used by the
+	top level declaration node, outside of the body of a function
+	'''
+	if isinstance(node, pycparser.c_ast.FuncDef):
+		node = node.decl
+	names = set()
+	nodes = [node]
+	while nodes:
+		node = nodes.pop()
+		if isinstance(node, pycparser.c_ast.IdentifierType):
+			names.update(node.names)
+		elif isinstance(node, pycparser.c_ast.ID):
+			names.add(node.name)
+		elif isinstance(node, pycparser.c_ast.Struct) and node.name:
+			names.add('struct %s' % node.name)
+		elif isinstance(node, pycparser.c_ast.Union) and node.name:
+			names.add('union %s' % node.name)
+		elif isinstance(node, pycparser.c_ast.Enum) and node.name:
+			names.add('enum %s' % node.name)
+		nodes.extend(child for name, child in node.children())
+	return names
+
+
+def selectDeclarations(ast, pattern):
+	'''Returns the top level declarations of the ast defining the names
+	matched by pattern, along with the declarations of the types and
+	constants they refer to, directly or not, in their order in the source
+	'''
+	definitions = {}
+	pending = []
+	for i, node in enumerate(ast.ext):
+		for name in definedNames(node):
+			definitions.setdefault(name, []).append(i)
+			if pattern.match(name):
+				pending.append(i)
+	selected = set()
+	while pending:
+		i = pending.pop()
+		if i not in selected:
+			selected.add(i)
+			for name in referencedNames(ast.ext[i]):
+				pending.extend(definitions.get(name, []))
+	return [ast.ext[i] for i in sorted(selected)]
+
+
 class InterfaceTranslator(pycparser.c_ast.NodeVisitor):
 	'''This class contains the algorithms used to convert the C source into
 	Python objects.  It uses the pycparser visit_* functions to convert the
@@ -1254,16 +1346,15 @@ def cast_value(tipo, value):
 		raise ValueError('Invalid type: %s' % tipo)
 
 
-anonNameCounter = 0
+anonNameCounter = itertools.count(1)
 def newAnonymousName():
-	global anonNameCounter
-	anonNameCounter += 1
 	prefix = '__include_anon'
 	suffix = '__'
-	return prefix + str(anonNameCounter) + suffix
+	return prefix + str(next(anonNameCounter) ) + suffix
 
 
 import pycparser.c_lexer
+import pycparser.c_parser
 cachedCLexerInit = pycparser.c_lexer.CLexer.__init__
 
 def CInterfaceLexerInit(self, *args, **kwargs):
@@ -1275,26 +1366,73 @@ def CInterfaceLexerInit(self, *args, **kwargs):
 	self.tokens += new_keywords
 
 
+cachedYacc = pycparser.c_parser.yacc
+
+class moduleDirectoryYacc(object):
+	'''Stands in for the yacc module used by pycparser.c_parser, so that
+	the parser tables are written in the module directory rather than the
+	current directory
+	'''
+	@staticmethod
+	def yacc(*args, **kwargs):
+		kwargs['outputdir'] = _moduleDirectory
+		return cachedYacc.yacc(*args, **kwargs)
+
+# The name of the module holding the parser tables, which is imported
+# from the package rather than the current directory
+if '.' in __name__:
+	yacctabModule = __name__.rsplit('.', 1)[0] + '.yacctab'
+else:
+	yacctabModule = 'yacctab'
+
+# Held while pycparser is patched to build a CInterfaceParser
+parserConstruction = threading.Lock()
+
+
 class CInterfaceParser(pycparser.CParser):
 	def __init__(self, lex_optimize=True,
 			lextab='pycparser.lextab',
 			yacc_optimize=True,
-			yacctab='yacctab',
+			yacctab=yacctabModule,
 			yacc_debug=False):
-		'''Initialize the parser'''
-		# Write the yacctab file in the module directory
-		# rather than the current directory
-		cachedDir = os.path.abspath(os.curdir)
-		os.chdir(os.path.abspath(os.path.dirname(__file__) ) )
-		if not os.path.exists('yacctab.py'):
+		'''Initialize the parser.  The working directory is not changed, so
+		parsers may be built while other threads preprocess files.
+		'''
+		if not os.path.exists(os.path.join(_moduleDirectory, 'yacctab.py') ):
 			yacc_optimize = False
-		# Extend the lexer by temporarily monkey-patching the
-		# __init__ method of the CLexer class
-		pycparser.c_lexer.CLexer.__init__ = CInterfaceLexerInit
-		super(type(self), self).__init__(lex_optimize, lextab, yacc_optimize, yacctab, yacc_debug)
-		pycparser.c_lexer.CLexer.__init__ = cachedCLexerInit
-		os.chdir(cachedDir)
+		# Extend the lexer and write the yacctab file in the module
+		# directory by temporarily monkey-patching pycparser
+		with parserConstruction:
+			pycparser.c_lexer.CLexer.__init__ = CInterfaceLexerInit
+			pycparser.c_parser.yacc = moduleDirectoryYacc
+			try:
+				super(type(self), self).__init__(lex_optimize, lextab, yacc_optimize, yacctab, yacc_debug)
+			finally:
+				pycparser.c_lexer.CLexer.__init__ = cachedCLexerInit
+				pycparser.c_parser.yacc = cachedYacc
+	
+	
+	def parseLines(self, pieces, filename='', typedefs=()):
+		'''Parses the preprocessed source given as an iterable of strings,
+		such as the generator returned by cpp.iter_preprocess, and returns
+		the AST like parse.  The strings are read through a TokenLexer as the
+		parser needs more tokens, so they are never joined.  The names in
+		typedefs are taken as type names declared before the source.
+		'''
+		self.clex.filename = filename
+		self.clex.reset_lineno()
+		self._scope_stack = [dict.fromkeys(typedefs, True)]
+		self._last_yielded_token = None
+		clex = self.clex
+		self.clex = TokenLexer(clex, pieces)
+		try:
+			return self.cparser.parse(input=None, lexer=self.clex, debug=0)
+		finally:
+			self.clex = clex
 	
+	def typedefNames(self):
+		'''Returns the type names declared at file scope by the last parse'''
+		return [name for name, isType in self._scope_stack[0].items() if isType]
 	
 	def p_function_specifier(self, p):
 		''' function_specifier  : INLINE
@@ -1304,13 +1442,325 @@ class CInterfaceParser(pycparser.CParser):
 		p[0] = p[1]
 
 
-def interpret(filename, libs=None, includePath='',
-		macroDefinitions=None, encoding=None):
-	'''Pass in the name of the header or C source file to include,
-	a list of the loaded libraries to search for the symbols to run,
-	and a list of path names to use searching for included files.
-	This function returns an object containing all the valid symbols defined
-	in the include files that can be found in the libraries.
+class TokenLexer(object):
+	'''A lexer for CInterfaceParser that reads the preprocessed source as
+	the pieces yielded by cpp.iter_preprocess.  Each piece is split with the
+	preprocessing token pattern of cpp, and each distinct token string is
+	classified once by the lexer of the parser, instead of matching every
+	token against the pattern of every token type.  Identifiers are looked
+	up as type names, and braces open and close scopes, when the parser
+	reads them, as CLexer does.  A piece holding a token that CLexer would
+	not read as the same single token, such as a wide string, a '$', or a
+	line directive, is lexed by CLexer itself.
+	'''
+	identifier = re.compile(r'[a-zA-Z_][0-9a-zA-Z_]*$')
+	
+	def __init__(self, clex, pieces):
+		try:
+			from . import cpp
+		except ImportError:
+			import cpp
+		self.clex = clex
+		self.split = cpp.ppTokenList.findall
+		self.pieces = iter(pieces)
+		self.filename = clex.filename
+		self.last_token = None
+		self.lineno = clex.lexer.lineno
+		self.lexdata = ''
+		# The token strings of the current piece, the index of the next one,
+		# and its position in the piece
+		self.strands = []
+		self.index = 0
+		self.lexpos = 0
+		# True while the current piece is lexed by CLexer
+		self.fallback = 0
+		# The type of each token string: '' for whitespace, 'ID' for an
+		# identifier that is not a keyword, or False if it is lexed by CLexer
+		self.types = {'{': 'LBRACE', '}': 'RBRACE'}
+		self.classifier = clex.lexer.clone()
+	
+	def input(self, text):
+		self.pieces = iter([text])
+	
+	def find_tok_column(self, token):
+		'''Find the column of the token in its line'''
+		last_cr = self.lexdata.rfind('\n', 0, token.lexpos)
+		return token.lexpos - last_cr
+	
+	def classify(self, s):
+		'''Returns the type of the token string s, or False if CLexer would
+		not read it as a single token
+		'''
+		if not s.strip(' \t\n'):
+			return ''
+		if self.identifier.match(s):
+			return self.clex.keyword_map.get(s, 'ID')
+		if s[0] == '#' or '$' in s:
+			return False
+		lexer = self.classifier
+		try:
+			lexer.begin('INITIAL')
+			lexer.input(s)
+			t = lexer.token()
+			if t is None or t.value != s or lexer.token() is not None:
+				return False
+		except Exception:
+			return False
+		return t.type
+	
+	def load(self, piece):
+		'''Makes piece the current piece of the source'''
+		self.lexdata = piece
+		self.lexpos = 0
+		self.index = 0
+		self.strands = strands = self.split(piece)
+		types = self.types
+		for i, s in enumerate(strands):
+			kind = types.get(s)
+			if kind is None:
+				kind = types[s] = self.classify(s)
+			if kind is False or (s == 'L' and strands[i+1:i+2] and strands[i+1][0] in '"\''):
+				self.strands = []
+				self.fallback = 1
+				self.clex.lexer.lineno = self.lineno
+				self.clex.input(piece)
+				return
+	
+	def token(self):
+		while 1:
+			if self.fallback:
+				t = self.clex.token()
+				if t is not None:
+					self.filename = self.clex.filename
+					self.last_token = t
+					return t
+				# A line directive sets the file name without yielding a token
+				self.fallback = 0
+				self.filename = self.clex.filename
+				self.lineno = self.clex.lexer.lineno
+			strands = self.strands
+			while self.index < len(strands):
+				s = strands[self.index]
+				self.index += 1
+				kind = self.types[s]
+				lexpos = self.lexpos
+				self.lexpos += len(s)
+				if kind == '':
+					self.lineno += s.count('\n')
+					continue
+				if kind == 'ID':
+					if self.clex.type_lookup_func(s):
+						kind = 'TYPEID'
+				elif kind == 'LBRACE':
+					self.clex.on_lbrace_func()
+				elif kind == 'RBRACE':
+					self.clex.on_rbrace_func()
+				t = LexToken()
+				t.type = kind
+				t.value = s
+				t.lineno = self.lineno
+				t.lexpos = lexpos
+				self.last_token = t
+				return t
+			piece = next(self.pieces, None)
+			if piece is None:
+				self.last_token = None
+				return None
+			# Tokens may continue from a piece that does not end a line
+			while piece[-1:] != '\n':
+				more = next(self.pieces, None)
+				if more is None:
+					break
+				piece += more
+			self.load(piece)
+
+
+# Words whose parenthesized arguments are not the parameters of a function
+attributeWords = ['__attribute__', '__attribute', '__declspec', '__asm__', '__asm', 'asm']
+
+def iterDeclarations(lines):
+	'''Yields the top level declarations of the preprocessed source given as
+	an iterable of strings, as tuples of the list of their preprocessing
+	tokens, the index in it of the '{' starting the body of a function
+	definition or None, and whether the declaration is static.  The
+	whitespace following a declaration is yielded with it.
+	'''
+	try:
+		from . import cpp
+	except ImportError:
+		import cpp
+	# The tokens of the declaration read so far, its brace and parenthesis
+	# depth, and whether it has a static storage class, a parenthesized
+	# list that is not an attribute, an initializer, and its final ';' or '}'
+	tokens = []
+	depth = parens = 0
+	static = function = initialized = complete = False
+	body = None
+	previous = ''
+	pending = ''
+	for piece in itertools.chain(lines, [None]):
+		if piece is None:
+			piece = pending
+		else:
+			# Tokens may continue from a piece that does not end a line
+			piece = pending + piece
+			if piece[-1:] != '\n':
+				pending = piece
+				continue
+		pending = ''
+		for s in cpp.ppTokenList.findall(piece):
+			if complete and not s.isspace():
+				yield tokens, body, static
+				tokens = []
+				static = function = initialized = complete = False
+				body = None
+			tokens.append(s)
+			if complete or s.isspace():
+				continue
+			if body is not None:
+				if s == '{':
+					depth += 1
+				elif s == '}':
+					depth -= 1
+					complete = not depth
+				continue
+			if s == '{' and not depth and not parens and previous == ')' and function and not initialized:
+				body = len(tokens) - 1
+				depth = 1
+				continue
+			if s == '(':
+				if not parens and not depth and previous not in attributeWords:
+					function = True
+				parens += 1
+			elif s == ')':
+				parens -= 1
+			elif s == '{':
+				depth += 1
+			elif s == '}':
+				depth -= 1
+			elif s == 'static' and not parens and not depth:
+				static = True
+			elif s == '=' and not parens and not depth:
+				initialized = True
+			elif s == ';' and not parens and not depth:
+				complete = True
+			previous = s
+	if tokens:
+		yield tokens, body, static
+
+
+def stripDefinitions(lines):
+	'''Yields the preprocessed source given as an iterable of strings, with
+	each function definition replaced by its prototype, and the static
+	function definitions left out, since the InterfaceTranslator skips them.
+	The newlines of the removed text are kept, so that the parser reports
+	the same line numbers.
+	'''
+	for tokens, body, static in iterDeclarations(lines):
+		if body is None or tokens.count('{') != tokens.count('}'):
+			# Leave an unterminated body for the parser to report
+			yield ''.join(tokens)
+			continue
+		end = len(tokens)
+		while tokens[end - 1].isspace():
+			end -= 1
+		if static:
+			yield '\n' * ''.join(tokens[:end]).count('\n')
+		else:
+			yield ''.join(tokens[:body]) + ';' + '\n' * ''.join(tokens[body:end]).count('\n')
+		yield ''.join(tokens[end:])
+
+
+# The parser of a worker process of parseDeclarations
+chunkParser = None
+
+
+def parseChunk(chunk):
+	'''Parses one of the chunks of parseDeclarations in a worker process,
+	and returns its top level declarations
+	'''
+	global chunkParser
+	text, filename, typedefs = chunk
+	if chunkParser is None:
+		chunkParser = CInterfaceParser()
+	ext = chunkParser.parseLines([text], filename, typedefs).ext
+	# The coordinates would take most of the time to send the nodes back
+	nodes = list(ext)
+	while nodes:
+		node = nodes.pop()
+		node.coord = None
+		nodes.extend(child for name, child in node.children())
+	return ext
+
+
+def parseDeclarations(lines, filename='', jobs=None):
+	'''Parses the preprocessed source given as an iterable of strings in
+	jobs worker processes, or as many as there are CPUs if jobs is None,
+	and returns the AST like CInterfaceParser.parse, but without the
+	coordinates of the nodes.  The source is split into chunks of whole top
+	level declarations.  Before they are sent to the workers, the typedefs
+	of each chunk are parsed in order, to find the type names declared
+	before the next one.
+	'''
+	import multiprocessing
+	if jobs == None:
+		jobs = multiprocessing.cpu_count()
+	parser = CInterfaceParser()
+	if jobs <= 1:
+		return parser.parseLines(lines, filename)
+	declarations = []
+	size = 0
+	for tokens, body, static in iterDeclarations(lines):
+		text = ''.join(tokens)
+		isTypedef = next((t for t in tokens if not t.isspace()), '') == 'typedef'
+		declarations.append((text, isTypedef))
+		size += len(text)
+	# Make more chunks than workers, as their parsing times vary
+	chunkSize = size // (jobs * 4) + 1
+	chunks = []
+	typedefs = []
+	newlines = 0
+	start = length = 0
+	try:
+		for i, declaration in enumerate(declarations):
+			length += len(declaration[0])
+			if length < chunkSize and i + 1 < len(declarations):
+				continue
+			texts = [d[0] for d in declarations[start:i + 1]]
+			chunks.append(('\n' * newlines + ''.join(texts), filename, typedefs))
+			if i + 1 < len(declarations) and any(d[1] for d in declarations[start:i + 1]):
+				# The other declarations are parsed as empty lines
+				parser.parseLines(['\n' * newlines] + [d[0] if d[1] else '\n' * d[0].count('\n')
+						for d in declarations[start:i + 1]], filename, typedefs)
+				typedefs = parser.typedefNames()
+			newlines += sum(t.count('\n') for t in texts)
+			start = i + 1
+			length = 0
+		if len(chunks) <= 1:
+			return parser.parseLines([c[0] for c in chunks], filename)
+		pool = multiprocessing.Pool(min(jobs, len(chunks)))
+		# Collecting garbage while the nodes are unpickled would take longer
+		# than parsing them, and they hold no cycles
+		collecting = gc.isenabled()
+		gc.disable()
+		try:
+			results = pool.map(parseChunk, chunks, 1)
+		finally:
+			if collecting:
+				gc.enable()
+			pool.close()
+			pool.join()
+	except pycparser.plyparser.ParseError:
+		# Parse the whole source to report the first error as parse does
+		return parser.parseLines([d[0] for d in declarations], filename)
+	return pycparser.c_ast.FileAST([node for ext in results for node in ext])
+
+
+def prepareDefinitions(includePath, macroDefinitions):
+	'''Returns the include path and the macro definitions to preprocess
+	with: the macros describing the sizes of C types used by the
+	cinterface headers are defined, and the directory of those headers is
+	added to the include path unless it contains '^'
 	'''
 	try:
 		from . import cpp
@@ -1322,6 +1772,8 @@ def interpret(filename, libs=None, includePath='',
 		macroDefinitions = {}
 	if isinstance(includePath, basestringTypes):
 		includePath = [includePath]
+	else:
+		includePath = list(includePath)
 	
 	# initialize the variables needed to use the cinterface headers
 	shortBits = str(ctypes.sizeof(ctypes.c_short) * 8)
@@ -1358,18 +1810,125 @@ def interpret(filename, libs=None, includePath='',
 	customMacros = ['__asm__(x) ', '__asm(x) ']
 	for item in customMacros:
 		cpp.defineMacro(item, macroDefinitions)
-	ppsource = cpp.preprocess(filename, macroDefinitions, includePath, encoding=encoding)
+	return includePath, macroDefinitions
+
+
+def snapshot(headers, includePath='', macroDefinitions=None, encoding=None):
+	'''Preprocess the headers in the list headers, such as the C library
+	headers used by several libraries, and return the resulting state.
+	Passing it as the snapshot argument of include avoids preprocessing
+	these headers again.  The other arguments are the same as for include.
+	'''
+	try:
+		from . import cpp
+	except ImportError:
+		import cpp
+	if not includePath:
+		includePath = [os.curdir]
+	includePath, macroDefinitions = prepareDefinitions(includePath, macroDefinitions)
+	return cpp.snapshot(headers, macroDefinitions, includePath, encoding)
+
+
+def dependencies(filename, includePath='', macroDefinitions=None, encoding=None, system=True):
+	'''Returns the list of files that including filename reads, without
+	preprocessing the text of the files.  If system is false, the files
+	found in the standard include directories are left out.  The other
+	arguments are the same as for include.
+	'''
+	try:
+		from . import cpp
+	except ImportError:
+		import cpp
+	if not includePath:
+		includePath = [os.curdir]
+	includePath, macroDefinitions = prepareDefinitions(includePath, macroDefinitions)
+	return cpp.dependencies(filename, macroDefinitions, includePath, encoding, system)
+
+
+def macros(filename, includePath='', macroDefinitions=None, encoding=None):
+	'''Returns the macros defined by filename, translated as by include,
+	without parsing or preprocessing the text of the files.  This is much
+	faster than include when only the constants are needed.  The arguments
+	are the same as for include.
+	'''
+	try:
+		from . import cpp
+	except ImportError:
+		import cpp
+	if not includePath:
+		includePath = [os.curdir]
+	includePath, macroDefinitions = prepareDefinitions(includePath, macroDefinitions)
+	cpp.preprocessDirectives(filename, macroDefinitions, includePath, encoding)
+	return cpp.translateMacros(macroDefinitions)
+
+
+def interpret(filename, libs=None, includePath='',
+		macroDefinitions=None, encoding=None, cache=None, snapshot=None, stream=True, bodies=True,
+		symbols=None, jobs=1):
+	'''Pass in the name of the header or C source file to include,
+	a list of the loaded libraries to search for the symbols to run,
+	and a list of path names to use searching for included files.
+	This function returns an object containing all the valid symbols defined
+	in the include files that can be found in the libraries.  If cache
+	names a directory, the preprocessed header is saved there and reused
+	while the headers and definitions are unchanged.  If snapshot is the
+	result of the snapshot function, preprocessing starts from its state
+	and its headers are parsed along with the given file.  Unless stream
+	is false, the parser reads the lines as the preprocessor yields them
+	through a TokenLexer, instead of lexing the joined output.  If bodies
+	is false, function definitions are parsed as prototypes, and static
+	function definitions are not parsed at all.  If symbols is given, as a
+	glob pattern or a list of them, only the declarations and macros with
+	matching names are translated, along with the typedefs, structures,
+	unions, enumerations and constants they depend on.  A tag is matched as
+	'struct name', 'union name' or 'enum name'.  If jobs is not 1, the
+	declarations are parsed in that many processes by parseDeclarations.
+	'''
+	try:
+		from . import cpp
+	except ImportError:
+		import cpp
+	
+	if snapshot is not None:
+		macroDefinitions = snapshot.fork(macroDefinitions)
+	includePath, macroDefinitions = prepareDefinitions(includePath, macroDefinitions)
+	parser = CInterfaceParser()
+	if stream:
+		lines = cpp.iter_preprocess(filename, macroDefinitions, includePath, encoding=encoding, cache=cache)
+		if snapshot is not None:
+			lines = itertools.chain([snapshot.output], lines)
+		if not bodies:
+			lines = stripDefinitions(lines)
+		if jobs == 1:
+			ast = parser.parseLines(lines, filename)
+		else:
+			ast = parseDeclarations(lines, filename, jobs)
+	else:
+		ppsource = cpp.preprocess(filename, macroDefinitions, includePath, encoding=encoding, cache=cache)
+		if snapshot is not None:
+			ppsource = snapshot.output + ppsource
+		if not bodies:
+			ppsource = ''.join(stripDefinitions([ppsource]))
+		if jobs == 1:
+			ast = parser.parse(ppsource, filename)
+		else:
+			ast = parseDeclarations([ppsource], filename, jobs)
 	for value in ['struct', 'union', 'enum']:
 		if value in macroDefinitions:
 			log.warning('File defines invalid macro: %s' % value)
 			del macroDefinitions[value]
-	parser = CInterfaceParser()
-	ast = parser.parse(ppsource, filename)
 
 	vf = InterfaceTranslator(libs)
-	vf.visit(ast)
+	if symbols is None:
+		vf.visit(ast)
+		translatedMacros = cpp.translateMacros(macroDefinitions)
+	else:
+		pattern = symbolPattern(symbols)
+		for node in selectDeclarations(ast, pattern):
+			vf.visit(node)
+		translatedMacros = cpp.translateMacros(macroDefinitions,
+				[name for name in macroDefinitions if pattern.match(name)])
 	
-	translatedMacros = cpp.translateMacros(macroDefinitions)
 	for item in translatedMacros:
 		if item not in vf.output:
 			vf.output[item] = translatedMacros[item]
@@ -1413,7 +1972,8 @@ def LoadLibrary(name, path=[]):
 
 
 def include(filename, libraries=None, includePath='', linkPath='',
-		macroDefinitions=None, encoding=None):
+		macroDefinitions=None, encoding=None, cache=None, snapshot=None, stream=True, bodies=True,
+		symbols=None, jobs=1):
 	'''Pass in the name of the header or C source file to include,
 	a list of the names of the library files to search for the symbols to
 	run, and a list of path names to use searching for included files.
@@ -1422,7 +1982,15 @@ def include(filename, libraries=None, includePath='', linkPath='',
 	the library files.  A directory containing minimal C99 header files will
 	be appended to the includePath; if this is undesired behavior, use a path
 	component with the single character '^' as one of the paths in includePath,
-	and that directory will not be included.
+	and that directory will not be included.  Pass a directory name as cache
+	to reuse the preprocessed header from earlier calls when possible, and
+	the result of snapshot as snapshot to skip preprocessing the headers it
+	covers.  Pass stream as false to parse the joined output of the
+	preprocessor instead of its lines, and bodies as false to skip parsing
+	the bodies of the functions defined in the headers.  Pass a list of
+	names or glob patterns as symbols to translate only those symbols and
+	the types they depend on, and a number of processes or None for one per
+	CPU as jobs to parse the declarations in parallel.
 	'''
 	if not isinstance(libraries, list):
 		if libraries == None:
@@ -1446,7 +2014,7 @@ def include(filename, libraries=None, includePath='', linkPath='',
 		libs.append(lib)
 	if not includePath:
 		includePath = [os.curdir]
-	return interpret(filename, libs, includePath, macroDefinitions, encoding)
+	return interpret(filename, libs, includePath, macroDefinitions, encoding, cache, snapshot, stream, bodies, symbols, jobs)
 
 
 def close(self):
@@ -1528,10 +2096,12 @@ def run_cli(argv=None):
 			help='Append library file search path')
 	clparser.add_option('-l', dest='libFile', action='append',
 			help='Add libraries to link with')
+	clparser.add_option('--cache', dest='cache',
+			help='Reuse preprocessed headers saved in DIR', metavar='DIR')
 	(options, args) = clparser.parse_args(argv)
 	
 	h = include(args[0], libraries=options.libFile, includePath=options.includePath, linkPath=options.linkPath,
-			macroDefinitions=clidefs, encoding=options.encoding)
+			macroDefinitions=clidefs, encoding=options.encoding, cache=options.cache)
 	if options.filename:
 		fname = options.filename
 	else:
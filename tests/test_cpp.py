@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+# File encoding: utf-8
+'''Regression tests of the preprocessor.  Run with pytest, or directly
+as python tests/test_cpp.py from the package root directory.
+'''
+from __future__ import with_statement
+from __future__ import absolute_import
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__) ) ) )
+from cinterface import cpp
+
+
+def preprocessText(text, defines = None, trace = None, **files):
+	'''Preprocesses text as the file main.h of a temporary directory that
+	also holds the given other files, with '_' in their names standing
+	for '.', and returns the output with blank lines removed
+	'''
+	directory = tempfile.mkdtemp()
+	try:
+		files['main_h'] = text
+		for name, content in files.items():
+			with open(os.path.join(directory, name.replace('_', '.') ), 'w') as f:
+				f.write(content)
+		output = cpp.preprocess(os.path.join(directory, 'main.h'), defines, [directory],
+				trace=trace)
+	finally:
+		shutil.rmtree(directory)
+	return '\n'.join(l.strip() for l in output.split('\n') if l.strip() )
+
+
+# The tokens of the output, so that it is compared without its whitespace
+tokens = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\w+|\S')
+
+
+def assertExpands(text, expected):
+	output = preprocessText(text)
+	assert tokens.findall(output) == tokens.findall(expected), output
+
+
+def assertSyntaxError(text, message):
+	try:
+		preprocessText(text)
+	except SyntaxError as e:
+		assert message in str(e), str(e)
+	else:
+		raise AssertionError('No SyntaxError for ' + repr(text) )
+
+
+def test_missingEndif():
+	assert preprocessText('#if 1\nint a;\n#else\nint b;\n#endif\n') == 'int a;'
+	assertSyntaxError('#if 0\nint a;\n#else\nint b;\n', 'Missing #endif')
+	assertSyntaxError('#if 1\nint a;\n#else\nint b;\n', 'Missing #endif')
+	assertSyntaxError('#if 1\nint a;\n#elif 0\nint b;\n', 'Missing #endif')
+	assertSyntaxError('#if 1\nint a;\n#elif 0\nint b;\n#else\nint c;\n', 'Missing #endif')
+	assertSyntaxError('#if 1\n#if 0\n#elif 1\n#else\n#endif\n#else\n#elif 0\n', 'Missing #endif')
+
+
+def test_standardExamples():
+	# The examples of C99 6.10.3.5
+	assertExpands('#define x 3\n#define f(a) f(x * (a))\n#undef x\n#define x 2\n'
+		'#define g f\n#define z z[0]\n#define h g(~\n#define m(a) a(w)\n#define w 0,1\n'
+		'#define t(a) a\n#define p() int\n#define q(x) x\n#define r(x,y) x ## y\n'
+		'#define str(x) # x\n'
+		'f(y+1) + f(f(z)) % t(t(g)(0) + t)(1);\n'
+		'g(x+(3,4)-w) | h 5) & m\n(f)^m(m);\n'
+		'p() i[q()] = { q(1), r(2,3), r(4,), r(,5), r(,) };\n'
+		'char c[2][6] = { str(hello), str() };\n',
+		'f(2 * (y+1)) + f(2 * (f(2 * (z[0])))) % f(2 * (0)) + t(1);\n'
+		'f(2 * (2+(3,4)-0,1)) | f(2 * (~ 5)) & f(2 * (0,1))^m(0,1);\n'
+		'int i[] = { 1, 23, 4, 5, };\nchar c[2][6] = { "hello", "" };\n')
+	assertExpands('#define str(s) # s\n#define xstr(s) str(s)\n'
+		'#define debug(s, t) printf("x" # s "= %d, x" # t "= %s", \\\n x ## s, x ## t)\n'
+		'#define INCFILE(n) vers ## n\n#define glue(a, b) a ## b\n'
+		'#define xglue(a, b) glue(a, b)\n#define HIGHLOW "hello"\n#define LOW LOW ", world"\n'
+		'debug(1, 2);\n'
+		'fputs(str(strncmp("abc\\0d", "abc", \'\\4\') // this goes away\n == 0) str(: @\\n), s);\n'
+		'xstr(INCFILE(2).h)\nglue(HIGH, LOW);\nxglue(HIGH, LOW)\n',
+		'printf("x" "1" "= %d, x" "2" "= %s", x1, x2);\n'
+		'fputs("strncmp(\\"abc\\\\0d\\", \\"abc\\", \'\\\\4\') == 0" ": @\\n", s);\n'
+		'"vers2.h"\n"hello";\n"hello" ", world"\n')
+	assertExpands('#define t(x,y,z) x ## y ## z\n'
+		'int j[] = { t(1,2,3), t(,4,5), t(6,,7), t(8,9,),\n'
+		' t(10,,), t(,11,), t(,,12), t(,,) };\n',
+		'int j[] = { 123, 45, 67, 89,\n 10, 11, 12, };\n')
+	assertExpands('#define debug(...) fprintf(stderr, __VA_ARGS__)\n'
+		'#define showlist(...) puts(#__VA_ARGS__)\n'
+		'#define report(test, ...) ((test)?puts(#test):\\\n printf(__VA_ARGS__))\n'
+		'debug("Flag");\ndebug("X = %d\\n", x);\n'
+		'showlist(The first, second, and third items.);\n'
+		'report(x>y, "x is %d but y is %d", x, y);\n',
+		'fprintf(stderr, "Flag");\nfprintf(stderr, "X = %d\\n", x);\n'
+		'puts("The first, second, and third items.");\n'
+		'((x>y)?puts("x>y"): printf("x is %d but y is %d", x, y));\n')
+
+
+def test_hideSetsAndVariadicArguments():
+	# A macro is not expanded again within its own replacement
+	assert preprocessText('#define foo foo\nfoo\n#define a b\n#define b a\na b\n') == 'foo\na b'
+	assertExpands('#define f(a) a*g\n#define g(a) f(a)\nf(2)(9)\n', '2*9*g')
+	assertExpands('#define AA BB\n#define BB(x) AA x\nBB(1)(2)\n', 'BB 1(2)')
+	# GNU , ## __VA_ARGS__ drops the comma when there are no arguments
+	assertExpands('#define e(fmt, ...) f(fmt, ## __VA_ARGS__)\ne("a"); e("a", 1, 2);\n',
+		'f("a"); f("a", 1, 2);')
+	assertExpands('#define v(...) [__VA_ARGS__]\n#define n(x, ...) x(__VA_ARGS__)\n'
+		'v() v(1) v((1, 2), 3) n(v, a, (b, c))\n', '[] [1] [(1, 2), 3] [a, (b, c)]')
+
+
+def test_includeGuardsSkipped():
+	# A guarded or #pragma once file is not read again, unless its guard
+	# was undefined or it has an #else
+	d = cpp.Definitions()
+	output = preprocessText('#include "g.h"\n#include "g.h"\n#include "o.h"\n#include "o.h"\n'
+		'#include "e.h"\n#include "e.h"\n#undef G_H\n#include "g.h"\n', d,
+		g_h='\n#ifndef G_H\n#define G_H\nint g;\n#endif\n\n', o_h='#pragma once\nint o;\n',
+		e_h='#ifndef E_H\n#define E_H\nint e;\n#else\nint again;\n#endif\n')
+	assert output == 'int g;\nint o;\nint e;\nint again;\nint g;', output
+	assert d['__CPP_stats__']['filesRead'] == 6, d['__CPP_stats__']
+	assert d['__CPP_stats__']['includesSkipped'] == 2, d['__CPP_stats__']
+
+
+def test_outputCache():
+	directory = tempfile.mkdtemp()
+	try:
+		cache = os.path.join(directory, 'cache')
+		main = os.path.join(directory, 'main.h')
+		with open(main, 'w') as f:
+			f.write('#include "a.h"\nint A;\n')
+		runs = []
+		for text in ['#define A a\n', None, '#define A b\n', None]:
+			if text:
+				with open(os.path.join(directory, 'a.h'), 'w') as f:
+					f.write(text)
+			d = {}
+			output = cpp.preprocess(main, d, [directory], cache=cache)
+			runs.append((output.strip(), d['A'], d['__CPP_stats__']['cacheHits']) )
+		# Editing the included file invalidates the entry
+		assert runs == [('int a;', 'a', 0), ('int a;', 'a', 1), ('int b;', 'b', 0),
+			('int b;', 'b', 1)], runs
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_streamingOutput():
+	directory = tempfile.mkdtemp()
+	try:
+		main = os.path.join(directory, 'main.h')
+		with open(os.path.join(directory, 'a.h'), 'w') as f:
+			f.write('#define A(x) x + 1\nint a;\n')
+		with open(main, 'w') as f:
+			f.write('#include "a.h"\n#define B b\nint A(B);\n#if A(1) == 2\nint two;\n#endif\n')
+		expected = cpp.preprocess(main, {}, [directory])
+		d = {}
+		assert ''.join(cpp.iter_preprocess(main, d, [directory]) ) == expected
+		assert d['B'] == 'b'
+		pieces = []
+		assert cpp.preprocess(main, {}, [directory], pieces.append) == ''
+		assert ''.join(pieces) == expected
+		# The output before a missing file is produced before the error
+		with open(main, 'a') as f:
+			f.write('#include "missing.h"\n')
+		lines = cpp.iter_preprocess(main, {}, [directory])
+		assert next(lines) == 'int a;\n'
+		try:
+			list(lines)
+		except (IOError, OSError) as e:
+			assert 'missing.h' in str(e), str(e)
+		else:
+			raise AssertionError('No error for a missing file')
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_includeResolutionCache():
+	directory = tempfile.mkdtemp()
+	try:
+		first, second = os.path.join(directory, 'first'), os.path.join(directory, 'second')
+		os.mkdir(first)
+		os.mkdir(second)
+		steps = [None, os.path.join(second, 'x.h'), None, os.path.join(first, 'x.h'), None]
+		found = []
+		for i, name in enumerate(steps):
+			if name:
+				open(name, 'w').close()
+				# Make sure the directory is seen to change
+				os.utime(os.path.dirname(name), (1000 + i, 1000 + i) )
+			key = ('x.h', (first, second), os.getcwd() )
+			entry = cpp.resolvedIncludes.get(key)
+			try:
+				found.append(cpp.findFile('x.h', [first, second]) )
+			except IOError:
+				found.append(None)
+			# The lookup is only made again after a change
+			assert (cpp.resolvedIncludes[key] is entry) == (i > 0 and not name)
+		# A file that is not found is remembered until it is added
+		assert found == [None, steps[1], steps[1], steps[3], steps[3]], found
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_snapshots():
+	directory = tempfile.mkdtemp()
+	try:
+		base = os.path.join(directory, 'base.h')
+		main = os.path.join(directory, 'main.h')
+		with open(base, 'w') as f:
+			f.write('#ifndef BASE_H\n#define BASE_H\n#define SIZE 4\n#define F(x) x[SIZE]\n'
+				'typedef int base;\n#endif\n')
+		with open(main, 'w') as f:
+			f.write('#include "base.h"\n#ifdef EXTRA\nint extra;\n#endif\nbase F(a);\n#define LOCAL 1\n')
+		nonBlank = lambda s: [l for l in s.split('\n') if l.strip()]
+		expected = nonBlank(cpp.preprocess(main, {}, [directory]) )
+		s = cpp.snapshot([base], {}, [directory])
+		d = s.fork()
+		assert nonBlank(s.output + cpp.preprocess(main, d, [directory]) ) == expected
+		assert d['__CPP_stats__']['includesSkipped'] == 1, d['__CPP_stats__']
+		# A fork is not changed by the others, and may add macros
+		assert 'LOCAL' in d and 'LOCAL' not in s.fork()
+		d = s.fork({'EXTRA': '1'})
+		assert nonBlank(cpp.preprocess(main, d, [directory]) ) == ['int extra;', 'base a[4];']
+		assert 'EXTRA' not in s.fork()
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_macroRecords():
+	plain = {}
+	d = cpp.Definitions()
+	for item in ['F(a, ...) a + __VA_ARGS__', 'O 1']:
+		cpp.defineMacro(item, plain)
+		cpp.defineMacro(item, d)
+	m = d.macros['F']
+	assert (m.kind, m.params, m.variadic) == ('function', ['a', '...'], True)
+	assert m.replacement == [('arg', 'a'), ('text', [' ', '+', ' ']), ('va', '__VA_ARGS__')]
+	assert d.macros['O'].kind == 'object'
+	# The dict view holds the old format, and converts both ways
+	assert dict(d) == plain and dict(cpp.Definitions(plain) ) == plain
+	assert d['__CPP_expansion__']['F'] == ['${a}', ' + ', '__VA_ARGS__']
+	d['__CPP_arguments__']['G'] = ['x']
+	d['__CPP_expansion__']['G'] = ['${x}', ' * 2']
+	d['G'] = callable
+	d['O'] = 'G(4)'
+	assert cpp.expandLine('G(3) O F(1, 2)', d) == '3 * 2 4 * 2 1 + 2'
+	del d['G']
+	assert 'G' not in d.macros and 'G' not in d['__CPP_arguments__']
+	assert cpp.expandLine('G(3)', d) == 'G(3)'
+
+
+def test_argumentSplitting():
+	for s, expected in [('a, b', ['a', 'b', 4]), ('', ['', 0]), ('0x1ULL', ['0x1ULL', 6]),
+			(' (1, 2) ,"x, y", \'(\' ', ['(1, 2)', '"x, y"', "'('", 21]),
+			('f(g(1,2)),  h  i ', ['f(g(1,2))', 'h i', 15])]:
+		assert cpp.splitArgumentList(s) == expected, s
+	d = cpp.Definitions()
+	cpp.defineMacro('M(a, b, c, d) #a b ## c d', d)
+	m = d.macros['M']
+	# Only the parameters used outside # and ## have their arguments expanded
+	assert (m.usedParams, m.stringified, m.pasted) == (frozenset(['d']), frozenset(['a']),
+		frozenset(['b', 'c']) )
+	text = ('#define M(a, b) [a|b]\n#define S(a, b) #a b\n#define X x\n'
+		'M((1, 2), "x, y") M(f(g(1,2)), ) S(X, X) M(,)\n')
+	expected = '[(1, 2)|"x, y"] [f(g(1,2))|] "X" x [|]'
+	assertExpands(text, expected)
+	legacy = preprocessText(text, {'__CPP_legacy__': '1'})
+	assert tokens.findall(legacy) == tokens.findall(expected), legacy
+	# The original engine does not recognize character constants
+	assertExpands('#define M(a, b) [a|b]\nM(\'(\', \')\')\n', "['('|')']")
+
+
+def test_linesPassedThrough():
+	text = ('#define A 1\nint x;\nint y = A;\nchar *s = "A";\nint z; /* A */\n'
+		'long w;\nint l = __LINE__;\n')
+	d = cpp.Definitions()
+	output = preprocessText(text, d)
+	assert output == 'int x;\nint y = 1;\nchar *s = "A";\nint z;\nlong w;\nint l = 7;', output
+	# A macro name in a string is a false positive, so the line is expanded
+	assert d['__CPP_stats__']['linesPassedThrough'] == 3, d['__CPP_stats__']
+	assert d['__CPP_stats__']['linesExpanded'] == 3, d['__CPP_stats__']
+	d = cpp.Definitions({'__CPP_legacy__': '1'})
+	assert preprocessText(text, d) == output
+	assert d['__CPP_stats__']['linesPassedThrough'] == 0, d['__CPP_stats__']
+	d = cpp.Definitions({'A': '1'})
+	assert not cpp.containsMacro('int A1, _A, a;', d) and cpp.containsMacro('x(A)', d)
+
+
+def test_objectLikeExpansionReuse():
+	# Each expansion is made again once a name it examined has changed
+	assert preprocessText('#define A B\n#define B 1\nA\n#undef B\nA\n'
+		'#define B 2\nA\n#undef A\nA\n#define A 3\nA\n') == '1\nB\n2\nA\n3'
+	assert preprocessText('#define CAT(a, b) a ## b\n#define X CAT(Y, Z)\n'
+		'#define YZ 1\nX\n#undef YZ\nX\n#define YZ 2\nX\n') == '1\nYZ\n2'
+	assert preprocessText('#define L __LINE__\nL\nL\n\nL\n') == '2\n3\n5'
+	# The arguments of a function-like macro may follow the object-like one
+	assert preprocessText('#define F(x) [x]\n#define G F\nG(1)\nG (2)\nG\n(3)\n'
+		'G;\n#undef F\nG(4)\n') == '[1]\n[2]\n[3]\nF;\nF(4)'
+	assert preprocessText('#define H(x) x\n#define K H\n#define M K(\nM 5)\nM 6)\n') == '5\n6'
+
+
+def test_objectLikeExpansionReuseAcrossCalls():
+	d = cpp.Definitions({'B': '1'})
+	assert preprocessText('#define A B\nA\n', d) == '1'
+	assert d.expansions
+	d['B'] = '2'
+	assert preprocessText('A\n', d) == '2'
+	del d['B']
+	assert preprocessText('A\n', d) == 'B'
+
+
+def test_conditionReuse():
+	# The same conditions are evaluated after changes to the macros they
+	# use directly, through other macros and through a function-like macro
+	fragment = ('#if ON\nyes\n#else\nno\n#endif\n'
+		'#if IS(V) > 1\nbig\n#elif defined(W) && W\nw\n#endif\n')
+	d = cpp.Definitions()
+	output = preprocessText('#define IS(x) x\n' + fragment +
+		'#define ON 1\n#define V 2\n' + fragment +
+		'#undef ON\n#define ON 0\n#define V LEVEL\n#define LEVEL 3\n' + fragment +
+		'#undef LEVEL\n#define W 1\n' + fragment +
+		'#undef IS\n#define IS(x) 0\n' + fragment, d)
+	assert output == 'no\nyes\nbig\nno\nbig\nno\nw\nno\nw', output
+	assert d['__CPP_stats__']['conditionCacheHits'] > 0, d['__CPP_stats__']
+
+
+def test_sharedHideSets():
+	assert not hasattr(cpp.Token('a', 'a'), '__dict__')
+	d = cpp.Definitions()
+	cpp.defineMacro('A x y B', d)
+	cpp.defineMacro('B z', d)
+	tokens = cpp.rescanTokens(cpp.lexTokens('A + A'), d)
+	assert ''.join(t.string for t in tokens) == 'x y z + x y z'
+	# The tokens of both expansions of A share one hide-set, and so do
+	# those of B
+	tokens = [t for t in tokens if not t.value.isspace()]
+	hideSets = dict((t.value, t.macroHistory) for t in tokens)
+	assert hideSets['x'] == frozenset(['A']) and hideSets['z'] == frozenset(['A', 'B'])
+	for t in tokens:
+		assert t.macroHistory is hideSets[t.value], t
+	a = cpp.internHideSet(['A'])
+	assert cpp.internHideSet(set(['A']) ) is a
+	assert cpp.hideSetAdd(cpp.emptyHideSet, 'A') is a and cpp.hideSetAdd(a, 'A') is a
+	assert cpp.hideSetUnion(a, cpp.internHideSet(['B']) ) is cpp.hideSetAdd(a, 'B')
+
+
+def test_hideSetTablesBounded():
+	text = ('#define F(x) G(x) x F\n#define G(x) [x] F\n' +
+		''.join('#define M%d(a) F(a) M%d(a)\nM%d(%d)\n' % (i, i - 1, i, i) for i in range(1, 40) ) )
+	expected = preprocessText(text)
+	maxHideSets = cpp.maxHideSets
+	cpp.maxHideSets = 10
+	cpp.hideSets.clear()
+	cpp.hideSetUnions.clear()
+	try:
+		assert preprocessText(text) == expected
+		assert len(cpp.hideSets) <= 11 and len(cpp.hideSetUnions) <= 11
+	finally:
+		cpp.maxHideSets = maxHideSets
+
+
+def test_integerConstants():
+	for expression in ['010 == 8', '010U == 8', '010L == 8', '010UL == 8', '010ull == 8',
+			'0x10 == 16', '0x10u == 16', '0X10L == 16', '0x10LU == 16', '12 == 12U',
+			'0xFFFFFFFFU == 4294967295', '0xFFFFFFFFFFFFFFFFULL == -1',
+			'0xFFFFFFFFFFFFFFFF == -1', '18446744073709551615 == -1',
+			'0x7FFFFFFFFFFFFFFF > 0', "'a' == 97", "'\\n' == 10", "'\\x41' == 65"]:
+		assert cpp.calculateValue(expression) == 1, expression
+	assert cpp.isCNumber('010U') == (2, 8)
+	assert cpp.isCNumber('0x10UL') == (4, 16)
+	assert cpp.isCNumber('0xFFFFFFFFFFFFFFFFULL') == (6, 2 ** 64 - 1)
+	assert cpp.isCNumber('0x10L') == (1, 16)
+
+
+def test_mixedSignedness():
+	# The signed operand is converted to the unsigned type
+	for expression, value in [('-1 < 0U', 0), ('-1 > 0U', 1), ('1 - 2U > 0', 1),
+			('-1 < 0', 1), ('-1L < 0', 1), ('-1 == 0xFFFFFFFFU', 1), ('0U - 1 == 4294967295', 1),
+			('-1 < 0ULL', 0)]:
+		assert cpp.calculateValue(expression) == value, expression
+
+
+def test_expressionOperators():
+	for expression, value in [('1 ? 2 : 3', 2), ('0 ? 2 : 3', 3), ('0 ? 1 : 0 ? 2 : 3', 3),
+			('1 ? 0 ? 4 : 5 : 6', 5), ('-7 / 2', -3), ('7 / -2', -3), ('-7 % 2', -1),
+			('1 + 2 * 3 - 4', 3), ('1 << 4 >> 2', 4), ('~0', -1), ('!0 + !5', 1),
+			('2 > 1 == 1', 1), ('6 & 3 | 8 ^ 1', 11), ('0 && 1 / 0', 0), ('1 || 1 / 0', 1),
+			('0 ? 1 / 0 : 7', 7)]:
+		assert cpp.calculateValue(expression) == value, expression
+	for expression in ['1 +', '(1', '1 2', '1 ? 2']:
+		try:
+			cpp.calculateValue(expression)
+		except SyntaxError:
+			pass
+		else:
+			raise AssertionError('No SyntaxError for ' + expression)
+
+
+def test_ifDirectives():
+	assert preprocessText('#define A 2\n#define F(x) (x + 1)\n'
+		'#if defined A && F(A) == 3 && !defined(B) && UNDEFINED == 0\nyes\n#endif\n'
+		'#if 010U == 8 && 0xFFFFFFFFFFFFFFFFULL == -1\nunsigned\n#endif\n'
+		'#if 0 && 1 / 0\n#elif A > 1 ? 1 : 1 / 0\nshort\n#endif\n') == 'yes\nunsigned\nshort'
+
+
+def runCli(argv):
+	'''Returns the standard output of the command line tool run with argv'''
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		assert cpp.run_cli(argv) == 0
+		return sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+
+
+def assertUsageError(argv):
+	stderr = sys.stderr
+	sys.stderr = StringIO()
+	try:
+		cpp.run_cli(argv)
+	except SystemExit as e:
+		assert e.code == 2, e.code
+	else:
+		raise AssertionError('No usage error for ' + ' '.join(argv) )
+	finally:
+		sys.stderr = stderr
+
+
+def test_dependencies():
+	directory = tempfile.mkdtemp()
+	try:
+		files = {'main.h': '#include "a.h"\n#if A_VALUE > 1\n#include "b h.h"\n#else\n'
+			'#include "c.h"\n#endif\nint x = A_VALUE;\n#include "a.h"\n',
+			'a.h': '#ifndef A_H\n#define A_H\n#define A_VALUE 2\n#endif\n', 'b h.h': 'int b;\n',
+			'c.h': 'int c;\n'}
+		for name, content in files.items():
+			with open(os.path.join(directory, name), 'w') as f:
+				f.write(content)
+		main = os.path.join(directory, 'main.h')
+		expected = [main, os.path.join(directory, 'a.h'), os.path.join(directory, 'b h.h')]
+		d = {}
+		assert cpp.dependencies(main, d, [directory]) == expected
+		assert d['A_VALUE'] == '2'
+		# The same files as a full run, in first-read order
+		d = {}
+		cpp.preprocess(main, d, [directory])
+		assert sorted(set(d['__CPP_dependencies__']) ) == sorted(expected)
+		assert cpp.formatDependencies('m.o', ['m.h', 'b h.h', '$x#']) == ('m.o: \\' + os.linesep +
+			'  m.h \\' + os.linesep + '  b\\ h.h \\' + os.linesep + '  $$x\\#' + os.linesep)
+		assert runCli(['-M', '-I', directory, main]) == cpp.formatDependencies('main.o',
+			expected) + '\n'
+		output = runCli(['-M', '--dependency-format', 'json', '--dependency-target', 't',
+			'-I', directory, main])
+		assert json.loads(output) == dict(target='t', dependencies=expected)
+		# The files of the standard include directories are left out by -MM
+		system = [p for p in cpp.defaultHeaderPaths() if os.path.exists(os.path.join(p, 'errno.h') )]
+		if system:
+			with open(os.path.join(directory, 'a.h'), 'a') as f:
+				f.write('#include <errno.h>\n')
+			files = cpp.dependencies(main, {}, [directory])
+			assert files[:2] == expected[:2] and os.path.join(system[0], 'errno.h') in files
+			assert cpp.dependencies(main, {}, [directory], system=0) == expected
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_macroDump():
+	directory = tempfile.mkdtemp()
+	try:
+		main = os.path.join(directory, 'main.h')
+		with open(os.path.join(directory, 'a.h'), 'w') as f:
+			f.write('#define A(x, ...) #x __VA_ARGS__\n#define P(a, b) a ## b\n#define B 2\n')
+		with open(main, 'w') as f:
+			f.write('#include "a.h"\n#if B > 1\n#define C A(1, 2)\n#else\n#define C 0\n#endif\n'
+				'#undef B\nint c = C;\n')
+		expected = {}
+		cpp.preprocess(main, expected, [directory])
+		d = {}
+		output = cpp.dumpMacros(main, d, [directory])
+		# The text lines are not expanded
+		assert d['__CPP_stats__']['linesExpanded'] == 0, d['__CPP_stats__']
+		volatile = lambda s: [l for l in s.split('\n') if '__DATE__' not in l and '__TIME__' not in l]
+		assert volatile(output) == volatile(cpp.stringifyDefinitions(expected) )
+		assert '#define C A(1, 2)' in output and '#define B' not in output
+		assert volatile(runCli(['-dM', '-I', directory, main]) ) == volatile(output + '\n')
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_preprocessMany():
+	directory = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(directory, 'common.h'), 'w') as f:
+			f.write('#ifndef COMMON_H\n#define COMMON_H\n#define TWICE(x) (2 * (x))\n#endif\n')
+		names = []
+		for i in range(3):
+			names.append(os.path.join(directory, 'f%d.h' % i) )
+			with open(names[-1], 'w') as f:
+				f.write('#include "common.h"\n#define V%d %d\nint v%d = TWICE(V%d + BASE);\n' % (i, i, i, i) )
+		defines = {'BASE': '10'}
+		expected = []
+		for name in names:
+			d = dict(defines)
+			expected.append((cpp.preprocess(name, d, [directory]), d['V' + name[-3]]) )
+		for jobs in [1, 2]:
+			results = cpp.preprocess_many(names, defines, [directory], jobs=jobs)
+			assert [(output, d['V' + name[-3]]) for name, (output, d) in zip(names, results)] == expected
+			# Each file starts from the same definitions
+			assert all('V0' not in d for output, d in results[1:])
+		assert defines == {'BASE': '10'}
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_concurrentPreprocessors():
+	directory = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(directory, 'inner.h'), 'w') as f:
+			f.write('#if VARIANT % 2\nint odd = __LINE__;\n#else\nint even = __LINE__;\n#endif\n'
+				'#define NAME __FILE__\n')
+		main = os.path.join(directory, 'main.h')
+		with open(main, 'w') as f:
+			f.write('#include "inner.h"\nconst char *name = NAME;\n'
+				'#include "inner.h"\nint variant = VARIANT, line = __LINE__;\n')
+		expected = [cpp.preprocess(main, {'VARIANT': str(i)}, [directory]) for i in range(8)]
+		results = [None] * 32
+		def run(i):
+			results[i] = cpp.preprocess(main, {'VARIANT': str(i % 8)}, [directory])
+		threads = [threading.Thread(target=run, args=(i,) ) for i in range(len(results) )]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		assert results == expected * 4
+		# A Preprocessor keeps its definitions from one call to the next,
+		# but only reads one file at a time
+		p = cpp.Preprocessor({'VARIANT': '1'}, [directory])
+		assert p.preprocess(main) == expected[1]
+		assert p.defines['NAME'] == '__FILE__'
+		lines = p.iter_preprocess(main)
+		next(lines)
+		try:
+			p.preprocess(main)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('No error for a second file')
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_macroStatistics():
+	trace = cpp.Trace(macros=1)
+	output = preprocessText('#define A 1 2\n#define F(x) [x A]\n#define G(y) F(y) F(y)\n'
+		'G(0)\nA A\nF(A)\n', trace=trace)
+	assert output == '[0 1 2] [0 1 2]\n1 2 1 2\n[1 2 1 2]', output
+	counts = dict((name, (entry['expansions'], entry['depth']) ) for name, entry in trace.macros.items() )
+	assert counts == {'A': (6, 3), 'F': (3, 2), 'G': (1, 1)}, counts
+	assert all(entry['tokens'] > 0 and entry['seconds'] >= 0 for entry in trace.macros.values() )
+	report = trace.macroReport(limit=2, key='expansions').split(os.linesep)
+	assert report[0] == 'Macros by expansions (expansions, tokens, depth, seconds):'
+	assert [l.split()[-1] for l in report[1:3]] == ['A', 'F'] and report[3] == '  ... 1 more macros'
+	assert cpp.Trace().macros is None
+
+
+def test_cliJobs():
+	directory = tempfile.mkdtemp()
+	try:
+		names = []
+		for subdirectory, text in [('x', 'int a;\n'), ('y', '#define B b\nint B;\n')]:
+			os.mkdir(os.path.join(directory, subdirectory) )
+			names.append(os.path.join(directory, subdirectory, 'a.h') )
+			with open(names[-1], 'w') as f:
+				f.write(text)
+		output = os.path.join(directory, 'out')
+		os.mkdir(output)
+		assertUsageError(['-j', '2', '--output-dir', output] + names)
+		assertUsageError(['-j', '2', '-M'] + names)
+		assertUsageError(['-j', '2', '-dM'] + names)
+		assertUsageError(['--output-dir', output, names[0]])
+		os.rename(names[1], os.path.join(directory, 'y', 'b.h') )
+		names[1] = os.path.join(directory, 'y', 'b.h')
+		assert cpp.run_cli(['-j', '2', '--output-dir', output] + names) == 0
+		assert sorted(os.listdir(output) ) == ['a.i', 'b.i']
+		with open(os.path.join(output, 'b.i') ) as f:
+			assert 'int b;' in f.read()
+	finally:
+		shutil.rmtree(directory)
+
+
+def test_traceCountsIncludeGuards():
+	trace = cpp.Trace()
+	output = preprocessText('#include "a.h"\n#include "b.h"\n', trace=trace,
+		a_h='#ifndef A_H\n#define A_H\nint a;\n#endif\n',
+		b_h='#if !defined(B_H)\n#define B_H\nint b;\n#endif\n')
+	assert output == 'int a;\nint b;'
+	assert trace.directives.get('ifndef') == 1, trace.directives
+	assert trace.directives.get('if') == 1, trace.directives
+	assert trace.directives.get('endif') == 2, trace.directives
+
+
+if __name__ == '__main__':
+	for name, test in sorted(globals().items() ):
+		if name.startswith('test_'):
+			test()
+	print('OK')
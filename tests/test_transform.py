@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# File encoding: utf-8
+'''Regression tests of the translation of headers into interfaces.  Run
+with pytest, or directly as python tests/test_transform.py from the
+package root directory.
+'''
+from __future__ import with_statement
+from __future__ import absolute_import
+
+import ctypes
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__) ) ) )
+from cinterface import transform
+
+# The symbols of the running process, which include the C library
+processLibrary = ctypes.CDLL(None)
+
+# Keys of an interface that change from one translation to the next, or
+# name the temporary directory
+volatileKeys = [':libraries:', '__DATE__', '__TIME__', '__FILE__']
+
+header = '''#include <stddef.h>
+#define N 3
+#define NAME "x"
+#define TWICE(x) (2 * (x))
+typedef struct node { struct node *next; int v[N]; } node;
+typedef union { int i; float f; } number;
+enum color { RED, GREEN = 5 };
+struct pair { struct { int a; } inner; enum color c; };
+size_t strlen(const char *s);
+int abs(int);
+typedef int (*compare)(const void *, const void *);
+static inline int twice(int x) { if (x) { return 2 * x; } return 0; }
+int atoi(const char *s) { return 0; }
+'''
+
+
+def interpretText(text, **options):
+	'''Translates text as the file main.h of a temporary directory, with
+	the symbols of the process as the library, and returns the interface
+	'''
+	directory = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(directory, 'main.h')
+		with open(filename, 'w') as f:
+			f.write(text)
+		return transform.interpret(filename, [processLibrary], [directory], **options)
+	finally:
+		shutil.rmtree(directory)
+
+
+def anonymous(name):
+	'''Returns name without the number of an anonymous type'''
+	return re.sub(r'__include_anon\d+__', '__include_anon__', name)
+
+
+def typeName(t):
+	'''Returns a description of the ctypes type t'''
+	if issubclass(t, ctypes._Pointer):
+		return 'POINTER(%s)' % typeName(t._type_)
+	if issubclass(t, ctypes.Array):
+		return '%s[%d]' % (typeName(t._type_), t._length_)
+	if hasattr(t, '_restype_'):
+		return 'FUNCTYPE(%s)' % ', '.join(typeName(a) for a in (t._restype_,) + tuple(t._argtypes_) )
+	return anonymous(t.__name__)
+
+
+def describe(value):
+	'''Returns a description of an interface or of one of its values that
+	only depends on the declarations translated
+	'''
+	if isinstance(value, transform.CFunctionPointer):
+		return ('function', typeName(value.function.restype), [typeName(t) for t in value.argtypes])
+	if isinstance(value, dict):
+		return sorted((anonymous(k), describe(v) ) for k, v in dict.items(value) if k not in volatileKeys)
+	if isinstance(value, type):
+		if issubclass(value, (ctypes.Structure, ctypes.Union) ):
+			return (typeName(value), [(f[0], typeName(f[1]) ) + tuple(f[2:]) for f in value._fields_])
+		return typeName(value)
+	return value
+
+
+def test_snapshot():
+	# The headers of a snapshot are not read again, but their declarations
+	# are still translated
+	s = transform.snapshot(['stddef.h'])
+	assert describe(interpretText(header, snapshot=s) ) == describe(interpretText(header) )
+
+
+def test_macros():
+	# The macros are translated as by interpret, without parsing the text
+	directory = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(directory, 'main.h')
+		with open(filename, 'w') as f:
+			f.write(header)
+		macros = transform.macros(filename, [directory])
+		interface = transform.interpret(filename, [processLibrary], [directory])
+	finally:
+		shutil.rmtree(directory)
+	assert (macros['N'], macros['NAME'], macros['TWICE']) == (3, '"x"', '(2 * (x))')
+	for name in macros:
+		if name not in volatileKeys:
+			assert describe(macros[name]) == describe(dict.__getitem__(interface, name) ), name
+
+
+def test_concurrentInterpret():
+	# Each thread builds its own parser, and none changes the directory
+	expected = describe(interpretText(header) )
+	directory = os.getcwd()
+	results = [None] * 4
+	def run(i):
+		results[i] = describe(interpretText(header) )
+	threads = [threading.Thread(target=run, args=(i,) ) for i in range(len(results) )]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	assert results == [expected] * len(results)
+	assert os.getcwd() == directory
+
+
+def show(node, showcoord=True):
+	'''Returns the text of the AST node, with the coordinates of its nodes
+	unless showcoord is false
+	'''
+	s = StringIO()
+	node.show(buf=s, showcoord=showcoord)
+	return s.getvalue()
+
+
+def test_tokenLexer():
+	# The AST is the same as that of CLexer, including the coordinates,
+	# when the pieces hold line directives, wide strings, '$' and tokens
+	# split across pieces
+	pieces = ['typedef int T;\n', '# 5 "x.h"\n', 'struct s { T a; char *w; long double d; };\n',
+		'static const char *name = "a\\"b" "c";\n', 'const int *w = L"wide";\n',
+		'int f(T x) { T y = x; { int T = 2; y = T; } return y + 0x1fUL + 1.5e3f + \'\\n\'; }\n',
+		'enum e { A = 1 << ', '2, B = A | 3 };\n', 'int g(int (*cb)(T, ...), ...);\n', 'T $v;\n']
+	parser = transform.CInterfaceParser()
+	expected = show(parser.parse(''.join(pieces), 'm.h') )
+	assert show(parser.parseLines(iter(pieces), 'm.h') ) == expected
+	assert parser.typedefNames() == ['T']
+	assert describe(interpretText(header, stream=False) ) == describe(interpretText(header) )
+
+
+def test_symbols():
+	# The requested names bring the types and constants they depend on
+	interface = interpretText(header, symbols=['strlen', 'struct pair', 'N*', 'compare'])
+	full = interpretText(header)
+	names = sorted(k for k in dict.keys(interface) if k not in volatileKeys)
+	assert names == sorted([':exportedVars:', 'struct', 'union', 'enum', 'size_t', 'RED', 'GREEN',
+		'strlen', 'compare', 'NULL', 'N', 'NAME']), names
+	assert sorted(anonymous(k) for k in dict.__getitem__(interface, 'struct') ) == ['__include_anon__', 'pair']
+	assert list(dict.__getitem__(interface, 'enum') ) == ['color']
+	for name in names:
+		if name not in ['struct', 'union', 'enum']:
+			assert describe(dict.__getitem__(interface, name) ) == describe(dict.__getitem__(full, name) ), name
+	assert (describe(dict.__getitem__(interface, 'struct')['pair']) ==
+		describe(dict.__getitem__(full, 'struct')['pair']) )
+	assert describe(interpretText(header, symbols='*') ) == describe(full)
+
+
+def test_parallelParsing():
+	# The type names declared in one chunk are known in the later ones,
+	# and a parameter hides one only within its function
+	lines = []
+	for i in range(40):
+		lines.append('typedef struct s%d { int a; } t%d;\n' % (i, i) )
+		lines.append('t%d f%d(t%d x, unsigned long n);\n' % (i, i, max(i - 1, 0) ) )
+		lines.append('int g%d(int t%d) { return t%d; }\n' % (i, i, i) )
+	expected = show(transform.parseDeclarations(iter(lines), 'm.h', 1), False)
+	assert show(transform.parseDeclarations(iter(lines), 'm.h', 2), False) == expected
+	assert describe(interpretText(header, jobs=2) ) == describe(interpretText(header) )
+
+
+def test_bodiesSkipped():
+	# Function bodies are not parsed, but the prototypes are the same
+	assert describe(interpretText(header, bodies=False) ) == describe(interpretText(header) )
+
+
+def test_bodiesSkippedKeepsInitializers():
+	# A brace following a parenthesized list after = starts an initializer
+	# rather than a function body
+	text = ('struct S { int a, b; };\nint q[] = (int[]){1};\n'
+		'static const struct S *p = &(const struct S){1, 2};\n'
+		'int (*fp)(int) = 0;\nint f(int x) { return x; }\nstatic int g(void) { return 0; }\n')
+	assert ''.join(transform.stripDefinitions([text]) ) == ('struct S { int a, b; };\n'
+		'int q[] = (int[]){1};\nstatic const struct S *p = &(const struct S){1, 2};\n'
+		'int (*fp)(int) = 0;\nint f(int x) ;\n\n')
+	assert describe(interpretText(text, bodies=False) ) == describe(interpretText(text) )
+
+
+if __name__ == '__main__':
+	for name, test in sorted(globals().items() ):
+		if name.startswith('test_'):
+			test()
+	print('OK')